@@ -16,16 +16,25 @@ MODIFIED: To control output column order and remove 'original_excel_row_num' fro
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import zeep
 import zeep.helpers
 from zeep.exceptions import Fault as SoapFault, TransportError, LookupError as ZeepLookupError
 from requests.exceptions import ConnectionError as RequestsConnectionError
 import datetime
 import time
+import hashlib
 import re # For parsing XML errors
 from collections import defaultdict
 import io
+import asyncio
+import threading
+import contextlib
+import functools
+import warnings
 from xml.etree import ElementTree as ET # For more robust XML parsing
+from xml.sax.saxutils import escape as xml_escape
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- Application Configuration ---
 APP_TITLE = "🤖 Tebra Charge Entry"
@@ -33,6 +42,17 @@ APP_SUBTITLE = "By Panacea Smart Solutions"
 APP_FOOTER = "Tebra Charge Entry Tool © 2025 | Panacea Smart Solutions | Developed by Saqib Sherwani"
 TEBRA_PRACTICE_NAME = "Pediatrics West" # Hardcoded Practice Name
 TEBRA_WSDL_URL = "https://webservice.kareo.com/services/soap/2.1/KareoServices.svc?singleWsdl"
+WSDL_CACHE_TIMEOUT = 86400 # Seconds a downloaded WSDL stays in zeep's on-disk SqliteCache
+MAX_CONCURRENT_API_CALLS = 8 # Upper bound on in-flight SOAP requests (lookup prefetch and encounter creation)
+HTTP_POOL_SIZE = 16 # Keep-alive connections held open to the Tebra host (>= MAX_CONCURRENT_API_CALLS)
+PROGRESS_UPDATES = 50 # Upper bound on progress bar redraws per processing stage
+CREATE_ENCOUNTER_MAX_PER_SEC = 20 # Ceiling on CreateEncounter starts across all workers (the old 50 ms per-group pause)
+LOOKUP_CACHE_TTL = 3600 # Seconds practice/provider/location/case lookups are reused across runs for the same account
+LOOKUP_CACHE_PREFIXES = ("practice_id_", "providers_", "locations_", "provider_id_", "location_id_", "patient_case_")
+CREATED_ENCOUNTERS_KEY = "created_encounters" # session_state {encounter fingerprint: EncounterID} for this account
+STATUS_DONE_REUSED = "Done (already created this session)" # Status of a group matching an encounter created earlier in this session
+_DIRECTORY_LOCKS = {} # (session id, kind, practice_id) -> Lock; kept out of st.session_state, which must stay picklable
+_DIRECTORY_LOCKS_GUARD = threading.Lock() # Held only while a per-directory lock is looked up or created
 
 # --- SET PAGE CONFIG MUST BE THE FIRST STREAMLIT COMMAND ---
 st.set_page_config(page_title=APP_TITLE, page_icon="🤖", layout="wide", initial_sidebar_state="expanded")
@@ -65,10 +85,13 @@ POS_CODE_MAP = {
     "TELEHEALTH": {"code": "10", "name": "Telehealth Provided in Patient’s Home"},
     "TELEHEALTH OFFICE": {"code": "02", "name": "Telehealth Provided Other than in Patient’s Home"},
 }
+# Reverse map for POS values given as a numeric code; the first entry listed for a code supplies its name
+POS_NAME_BY_CODE = {}
+for _pos_entry in POS_CODE_MAP.values(): POS_NAME_BY_CODE.setdefault(_pos_entry["code"], _pos_entry["name"])
 
-def apply_custom_styling():
-    # Styles remain the same as in TebraChargeEntry_v1.txt
-    st.markdown("""
+# Styles remain the same as in TebraChargeEntry_v1.txt. Built once at import; Streamlit drops elements a rerun
+# does not re-emit, so apply_custom_styling still injects this on every run, just without rebuilding the string.
+CUSTOM_CSS_HTML = """
         <style>
         @import url('https://fonts.googleapis.com/css2?family=Open+Sans:wght@400;600;700&display=swap');
         html, body, [class*="st-"] { font-family: 'Open Sans', sans-serif; }
@@ -97,41 +120,92 @@ def apply_custom_styling():
         [data-theme="dark"] [data-testid="stSidebar"] .stFileUploader>div>div>button { background-color: #6c757d !important; color: white !important; }
         [data-theme="dark"] [data-testid="stSidebar"] .stFileUploader>div>div>button:hover { background-color: #5a6268 !important; color: white !important; }
         </style>
-    """, unsafe_allow_html=True)
+    """
+
+def apply_custom_styling():
+    st.markdown(CUSTOM_CSS_HTML, unsafe_allow_html=True)
 
 def display_message(type, message):
     st.markdown(f'<div class="message-box {type}-message">{message}</div>', unsafe_allow_html=True)
 
+# Callers doing lookups in bulk pass a messages list so notices are collected and shown once, not one box per value
+def report_message(type, message, messages=None):
+    if messages is None: display_message(type, message)
+    else: messages.append((type, message))
+
+# WSDL types used by this app; resolved once per client in create_api_client and served by get_wsdl_type
+WSDL_TYPE_NAMES = [
+    'ns0:RequestHeader', 'ns0:GetPracticesReq', 'ns0:PracticeFilter', 'ns0:PracticeFieldsToReturn',
+    'ns0:GetProvidersReq', 'ns0:ProviderFilter', 'ns0:ProviderFieldsToReturn',
+    'ns6:GetServiceLocationsReq', 'ns6:ServiceLocationFilter', 'ns6:ServiceLocationFieldsToReturn',
+    'ns0:GetPatientReq', 'ns0:SinglePatientFilter', 'ns0:PatientIdentifierReq', 'ns0:ProviderIdentifierDetailedReq',
+    'ns0:EncounterServiceLocation', 'ns0:PracticeIdentifierReq', 'ns0:EncounterPlaceOfService', 'ns0:ServiceLineReq',
+    'ns0:EncounterCreate', 'ns0:CreateEncounterReq', 'ns0:PatientCaseIdentifierReq', 'ns0:ArrayOfServiceLineReq',
+]
+
+def get_wsdl_type(client_obj, type_name):
+    # client.get_type walks the parsed schema on every call; cache the result on the client object instead
+    type_cache = client_obj.__dict__.setdefault('_types', {})
+    if type_name not in type_cache: type_cache[type_name] = client_obj.get_type(type_name)
+    return type_cache[type_name]
+
 @st.cache_resource(ttl=3600)
 def create_api_client(wsdl_url):
     try:
         from requests import Session
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
         from zeep.transports import Transport
+        from zeep.cache import SqliteCache
+        import os, tempfile
         session = Session(); session.timeout = 60
-        transport = Transport(session=session, timeout=60)
+        # Pooled keep-alive connections let every SOAP call reuse an open TLS session instead of handshaking again.
+        # POST is not in Retry's default allowed_methods, so a CreateEncounter that reached the server is never replayed;
+        # connection failures and WSDL GETs are still retried with backoff.
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                              max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+        session.mount('https://', adapter); session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        # st.cache_resource keeps the parsed Client across reruns; the on-disk cache also spares the ~MB WSDL download
+        # when the resource expires or the server process restarts.
+        wsdl_cache = SqliteCache(path=os.path.join(tempfile.gettempdir(), 'tebra_zeep_wsdl_cache.db'), timeout=WSDL_CACHE_TIMEOUT)
+        transport = Transport(session=session, timeout=60, cache=wsdl_cache)
         client = zeep.Client(wsdl=wsdl_url, transport=transport)
+        for type_name in WSDL_TYPE_NAMES:
+            try: get_wsdl_type(client, type_name)
+            except ZeepLookupError: pass # Surfaced with context at the call site that needs it
         return client
     except Exception as e:
         st.error(f"Fatal Error: Could not initialize Zeep SOAP client: {e}")
         return None
 
+# escape() covers & < >; the quote entities keep the previous five-character escaping of the password
+XML_QUOTE_ENTITIES = {'"': '&quot;', "'": '&apos;'}
+
 def build_request_header(credentials, client):
     if not client: return None
     try:
-        header_type = client.get_type('ns0:RequestHeader')
-        pw = credentials['Password'].replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&apos;')
+        header_type = get_wsdl_type(client, 'ns0:RequestHeader')
+        pw = xml_escape(credentials['Password'], XML_QUOTE_ENTITIES)
         return header_type(CustomerKey=credentials['CustomerKey'], User=credentials['User'], Password=pw)
     except ZeepLookupError as le: display_message("error", f"Zeep LookupError building header: {le}. WSDL issue?"); return None
     except Exception as e: display_message("error", f"Error building API request header: {e}"); return None
 
-def format_datetime_for_api(date_value):
-    if pd.isna(date_value) or date_value is None: return None
-    try: return pd.to_datetime(date_value).strftime('%Y-%m-%dT%H:%M:%S')
-    except Exception as e: 
-        display_message("warning", f"Date parse warning: '{date_value}'. Error: {e}. Using None.")
-        return None
-
 # --- ID Lookup Functions ---
+# Lookup caches live in st.session_state, so they are per browser session. They are kept across runs and dropped
+# when the account changes or LOOKUP_CACHE_TTL passes; misses (None or an empty directory) are always retried on the next run.
+# Directory indexes are only stored when their directory is non-empty, so a failed fetch is never served for the TTL.
+def refresh_lookup_caches(credentials, allow_resubmit=False):
+    owner = hashlib.sha256(f"{credentials['CustomerKey']}|{credentials['User']}".encode()).hexdigest()
+    now = time.monotonic()
+    owner_changed = st.session_state.get("lookup_cache_owner") != owner
+    expired = owner_changed or now >= st.session_state.get("lookup_cache_expires", 0)
+    # Encounters created under another account don't apply; allow_resubmit lets a corrected sheet be sent again
+    if owner_changed or allow_resubmit: st.session_state.pop(CREATED_ENCOUNTERS_KEY, None)
+    for k in [k for k in st.session_state if k.startswith(LOOKUP_CACHE_PREFIXES)]:
+        if expired or not st.session_state[k]: del st.session_state[k]
+    if expired: st.session_state["lookup_cache_owner"], st.session_state["lookup_cache_expires"] = owner, now + LOOKUP_CACHE_TTL
+
 def get_practice_id_from_name(client_obj, header_obj, practice_name_to_find):
     if not client_obj or not header_obj: return None
     cache_key = f"practice_id_{practice_name_to_find}"
@@ -139,9 +213,9 @@ def get_practice_id_from_name(client_obj, header_obj, practice_name_to_find):
     with st.spinner(f"Verifying Practice '{practice_name_to_find}'..."):
         practice_id = None
         try:
-            req_type = client_obj.get_type('ns0:GetPracticesReq')
-            filter_type = client_obj.get_type('ns0:PracticeFilter')
-            fields_type = client_obj.get_type('ns0:PracticeFieldsToReturn')
+            req_type = get_wsdl_type(client_obj, 'ns0:GetPracticesReq')
+            filter_type = get_wsdl_type(client_obj, 'ns0:PracticeFilter')
+            fields_type = get_wsdl_type(client_obj, 'ns0:PracticeFieldsToReturn')
             fields = fields_type(ID=True, PracticeName=True)
             p_filter = filter_type(PracticeName=practice_name_to_find)
             req = req_type(RequestHeader=header_obj, Filter=p_filter, Fields=fields)
@@ -163,115 +237,178 @@ def get_practice_id_from_name(client_obj, header_obj, practice_name_to_find):
         st.session_state[cache_key] = practice_id
         return practice_id
 
-def get_provider_id_by_name(client_obj, header_obj, practice_id, provider_name_from_excel):
+def _directory_lock(kind, practice_id):
+    # One lock per directory (kind, practice) in this browser session, so concurrent lookups share a single fetch
+    # without serializing providers behind locations or blocking other sessions.
+    script_ctx = get_script_run_ctx() # Worker threads carry the session's context (add_script_run_ctx)
+    lock_key = (script_ctx.session_id if script_ctx else None, kind, practice_id)
+    with _DIRECTORY_LOCKS_GUARD: return _DIRECTORY_LOCKS.setdefault(lock_key, threading.Lock())
+
+def get_all_providers(client_obj, header_obj, practice_id, show_spinner=True):
+    # One broad GetProviders call per practice; every name lookup is then matched client-side against this list.
+    cache_key = f"providers_{practice_id}"
+    if cache_key in st.session_state: return st.session_state[cache_key]
+    with _directory_lock("providers", practice_id):
+        if cache_key in st.session_state: return st.session_state[cache_key]
+        providers_data = []
+        with (st.spinner(f"Loading providers for PracticeID {practice_id}...") if show_spinner else contextlib.nullcontext()):
+            try:
+                get_providers_req_type = get_wsdl_type(client_obj, 'ns0:GetProvidersReq')
+                provider_filter_type = get_wsdl_type(client_obj, 'ns0:ProviderFilter')
+                provider_fields_type = get_wsdl_type(client_obj, 'ns0:ProviderFieldsToReturn')
+                # Only the fields the provider index reads; every extra field is serialized for every provider in the practice
+                fields = provider_fields_type(ID=True, FullName=True, Active=True)
+                broad_filter = provider_filter_type(PracticeID=str(practice_id))
+                resp_all = client_obj.service.GetProviders(request=get_providers_req_type(RequestHeader=header_obj, Filter=broad_filter, Fields=fields))
+                if hasattr(resp_all, 'ErrorResponse') and resp_all.ErrorResponse and resp_all.ErrorResponse.IsError: raise Exception(f"API Error Broad Provider Search: {resp_all.ErrorResponse.ErrorMessage}")
+                if hasattr(resp_all, 'SecurityResponse') and resp_all.SecurityResponse and not resp_all.SecurityResponse.Authorized: raise Exception(f"Auth Error Broad Provider Search: {resp_all.SecurityResponse.SecurityResult}")
+                if hasattr(resp_all, 'Providers') and resp_all.Providers and hasattr(resp_all.Providers, 'ProviderData') and resp_all.Providers.ProviderData:
+                    providers_data = resp_all.Providers.ProviderData
+                    if not isinstance(providers_data, list): providers_data = [providers_data]
+            except SoapFault as sf: display_message("error", f"SOAP Fault GetProviders for PracticeID {practice_id}: {sf.message}")
+            except ZeepLookupError as le: display_message("error", f"Zeep Type Error GetProviders: {le}")
+            except Exception as e: display_message("error", f"Unexpected Error loading providers for PracticeID {practice_id}: {e}")
+        st.session_state[cache_key] = providers_data
+        return providers_data
+
+# Tebra returns boolean flags (Active, IsPrimaryCase) either as bools or as 'true'/'false' strings
+def _truthy(v):
+    return v is True or (isinstance(v, str) and v.lower() == 'true')
+
+_PROVIDER_NAME_STRIP = str.maketrans('', '', ',.') # Drops commas and periods in one pass, e.g. "Smith, J.D." -> "Smith JD"
+_PROVIDER_SUFFIXES = frozenset(['md', 'do', 'pa', 'np'])
+
+def provider_search_terms(name):
+    # Same terms as the original matcher: punctuation dropped, lowercased, credential suffixes removed, repeats kept
+    return [t for t in str(name).translate(_PROVIDER_NAME_STRIP).lower().split() if t not in _PROVIDER_SUFFIXES]
+
+def _provider_match_score(terms, name_lower):
+    # Substring matching, as before the index: 'smit', 'joh' and initials all count as a match
+    return (sum(1 for t in terms if t in name_lower) / len(terms)) * 90
+
+def get_provider_index(client_obj, header_obj, practice_id, show_spinner=True):
+    # Built once per practice from the provider directory: 'exact' maps a normalized FullName to its ID,
+    # 'tokens' maps each whole name word to the positions in 'entries'. The word index only narrows the search
+    # to likely candidates; scoring stays the substring match, and other entries are still scanned when they could win.
+    cache_key = f"providers_index_{practice_id}"
+    if cache_key in st.session_state: return st.session_state[cache_key]
+    all_providers_data = get_all_providers(client_obj, header_obj, practice_id, show_spinner=show_spinner)
+    with _directory_lock("providers", practice_id):
+        if cache_key in st.session_state: return st.session_state[cache_key]
+        provider_index = {"exact": {}, "entries": [], "tokens": defaultdict(set)}
+        for p_data in all_providers_data:
+            if not _truthy(getattr(p_data, 'Active', None)) or not (hasattr(p_data, 'FullName') and p_data.FullName) or not (hasattr(p_data, 'ID') and p_data.ID is not None): continue
+            name_api = p_data.FullName.strip().lower()
+            if not name_api: continue
+            if p_data.ID: provider_index["exact"].setdefault(name_api, int(p_data.ID))
+            entry_pos = len(provider_index["entries"])
+            provider_index["entries"].append({"ID": int(p_data.ID), "FullName": p_data.FullName, "name_lower": name_api})
+            for term in set(provider_search_terms(name_api)): provider_index["tokens"][term].add(entry_pos)
+        if all_providers_data: st.session_state[cache_key] = provider_index
+        return provider_index
+
+def get_provider_id_by_name(client_obj, header_obj, practice_id, provider_name_from_excel, show_spinner=True, messages=None):
     if not all([client_obj, header_obj, practice_id, provider_name_from_excel]):
-        display_message("error", "Missing parameters for Provider lookup.")
+        report_message("error", "Missing parameters for Provider lookup.", messages)
         return None
     provider_name_search = str(provider_name_from_excel).strip()
     if not provider_name_search:
-        display_message("warning", "Provider name to search is empty.")
+        report_message("warning", "Provider name to search is empty.", messages)
         return None
-    cache_key = f"provider_id_{practice_id}_{provider_name_search}"
+    search_lower = provider_name_search.lower() # Lowercased once; the index already holds lowercased directory names
+    cache_key = f"provider_id_{practice_id}_{search_lower}" # Matching is case-insensitive, so is the cache
     if cache_key in st.session_state: return st.session_state[cache_key]
     provider_id_found = None
-    with st.spinner(f"Finding ProviderID for '{provider_name_search}'..."):
-        try:
-            get_providers_req_type = client_obj.get_type('ns0:GetProvidersReq')
-            provider_filter_type = client_obj.get_type('ns0:ProviderFilter')
-            provider_fields_type = client_obj.get_type('ns0:ProviderFieldsToReturn')
-            fields = provider_fields_type(ID=True, FullName=True, FirstName=True, LastName=True, Active=True, PracticeID=True, Type=True)
-            exact_filter = provider_filter_type(FullName=provider_name_search, PracticeID=str(practice_id))
-            resp_exact = client_obj.service.GetProviders(request=get_providers_req_type(RequestHeader=header_obj, Filter=exact_filter, Fields=fields))
-            
-            exact_providers_data = []
-            if hasattr(resp_exact, 'Providers') and resp_exact.Providers and hasattr(resp_exact.Providers, 'ProviderData') and resp_exact.Providers.ProviderData:
-                exact_providers_data = resp_exact.Providers.ProviderData
-                if not isinstance(exact_providers_data, list): exact_providers_data = [exact_providers_data]
-
-            if not (hasattr(resp_exact, 'ErrorResponse') and resp_exact.ErrorResponse and resp_exact.ErrorResponse.IsError) and \
-               not (hasattr(resp_exact, 'SecurityResponse') and resp_exact.SecurityResponse and not resp_exact.SecurityResponse.Authorized) and \
-               exact_providers_data:
-                for p_data in exact_providers_data:
-                    is_active = (hasattr(p_data, 'Active') and p_data.Active is not None and ((isinstance(p_data.Active, bool) and p_data.Active) or (isinstance(p_data.Active, str) and p_data.Active.lower() == 'true')))
-                    if is_active and hasattr(p_data,'FullName') and p_data.FullName and p_data.FullName.strip().lower() == provider_name_search.lower() and hasattr(p_data,'ID') and p_data.ID:
-                        provider_id_found = int(p_data.ID)
-                        st.session_state[cache_key] = provider_id_found
-                        return provider_id_found
-            
-            if provider_id_found is None:
-                broad_filter = provider_filter_type(PracticeID=str(practice_id))
-                resp_all = client_obj.service.GetProviders(request=get_providers_req_type(RequestHeader=header_obj, Filter=broad_filter, Fields=fields))
-                if hasattr(resp_all, 'ErrorResponse') and resp_all.ErrorResponse and resp_all.ErrorResponse.IsError: raise Exception(f"API Error Broad Provider Search: {resp_all.ErrorResponse.ErrorMessage}")
-                if hasattr(resp_all, 'SecurityResponse') and resp_all.SecurityResponse and not resp_all.SecurityResponse.Authorized: raise Exception(f"Auth Error Broad Provider Search: {resp_all.SecurityResponse.SecurityResult}")
-                
-                found_providers_flex = []
-                all_providers_data_broad = []
-                if hasattr(resp_all, 'Providers') and resp_all.Providers and hasattr(resp_all.Providers, 'ProviderData') and resp_all.Providers.ProviderData:
-                    all_providers_data_broad = resp_all.Providers.ProviderData
-                    if not isinstance(all_providers_data_broad, list): all_providers_data_broad = [all_providers_data_broad]
-
-                if all_providers_data_broad:
-                    terms = [t.lower() for t in provider_name_search.replace(',', '').replace('.', '').split() if t.lower() not in ['md', 'do', 'pa', 'np'] and t]
-                    if not terms: terms = [provider_name_search.lower()]
-                    for p_item in all_providers_data_broad:
-                        is_active = (hasattr(p_item, 'Active') and p_item.Active is not None and ((isinstance(p_item.Active, bool) and p_item.Active) or (isinstance(p_item.Active, str) and p_item.Active.lower() == 'true')))
-                        if not is_active: continue
-                        name_api = p_item.FullName.strip().lower() if hasattr(p_item,'FullName') and p_item.FullName else ""
-                        if not name_api: continue
-                        score = 0
-                        if name_api == provider_name_search.lower(): score = 100
-                        elif terms: score = (sum(1 for t_term in terms if t_term in name_api) / len(terms)) * 90 if len(terms) > 0 else 0
-                        if score > 70 and hasattr(p_item,'ID') and p_item.ID is not None: found_providers_flex.append({"ID": int(p_item.ID), "FullName": p_item.FullName or "", "score": score})
-                
-                if found_providers_flex:
-                    best = sorted(found_providers_flex, key=lambda x: x['score'], reverse=True)[0]
-                    provider_id_found = best['ID']
-            
-            if provider_id_found is None: display_message("warning", f"Could not find suitable ACTIVE provider matching '{provider_name_search}'.")
-        except SoapFault as sf: display_message("error", f"SOAP Fault GetProviders for '{provider_name_search}': {sf.message}")
-        except ZeepLookupError as le: display_message("error", f"Zeep Type Error GetProviders: {le}")
-        except Exception as e: display_message("error", f"Unexpected Error finding ProviderID for '{provider_name_search}': {e}")
-        st.session_state[cache_key] = provider_id_found
-        return provider_id_found
-
-def get_location_id_by_name(client_obj, header_obj, practice_id, location_name_to_find):
+    provider_index = get_provider_index(client_obj, header_obj, practice_id, show_spinner=show_spinner)
+    try:
+        provider_id_found = provider_index["exact"].get(search_lower)
+        entries = provider_index["entries"]
+        if provider_id_found is None and entries:
+            terms = provider_search_terms(provider_name_search) or [search_lower]
+            # Highest score above 70 wins, the first in directory order on a tie (the old stable sort)
+            best_pos, best_score = None, None
+            def consider(entry_pos):
+                nonlocal best_pos, best_score
+                score = _provider_match_score(terms, entries[entry_pos]["name_lower"])
+                if score > 70 and (best_pos is None or score > best_score or (score == best_score and entry_pos < best_pos)): best_pos, best_score = entry_pos, score
+            candidate_positions = set().union(*(provider_index["tokens"].get(t, ()) for t in terms))
+            for entry_pos in sorted(candidate_positions): consider(entry_pos)
+            # Fragments like 'smit' miss the word index. 90 is the top flex score, so once a candidate has it
+            # only an earlier entry could still win the tie; otherwise every remaining entry is scored.
+            scan_limit = best_pos if best_score == 90 else len(entries)
+            for entry_pos in range(scan_limit):
+                if entry_pos not in candidate_positions: consider(entry_pos)
+            if best_pos is not None: provider_id_found = entries[best_pos]["ID"]
+
+        if provider_id_found is None: report_message("warning", f"Could not find suitable ACTIVE provider matching '{provider_name_search}'.", messages)
+    except Exception as e: report_message("error", f"Unexpected Error finding ProviderID for '{provider_name_search}': {e}", messages)
+    st.session_state[cache_key] = provider_id_found
+    return provider_id_found
+
+def get_all_locations(client_obj, header_obj, practice_id, show_spinner=True):
+    # One GetServiceLocations call per practice; location names are matched client-side against this list.
+    cache_key = f"locations_{practice_id}"
+    if cache_key in st.session_state: return st.session_state[cache_key]
+    with _directory_lock("locations", practice_id):
+        if cache_key in st.session_state: return st.session_state[cache_key]
+        locations_data = []
+        with (st.spinner(f"Loading service locations for PracticeID {practice_id}...") if show_spinner else contextlib.nullcontext()):
+            try:
+                req_type = get_wsdl_type(client_obj, 'ns6:GetServiceLocationsReq')
+                filter_type = get_wsdl_type(client_obj, 'ns6:ServiceLocationFilter')
+                fields_type = get_wsdl_type(client_obj, 'ns6:ServiceLocationFieldsToReturn')
+                fields = fields_type(ID=True, Name=True, PracticeID=True)
+                loc_filter = filter_type(PracticeID=str(practice_id))
+                req = req_type(RequestHeader=header_obj, Filter=loc_filter, Fields=fields)
+                resp = client_obj.service.GetServiceLocations(request=req)
+                if hasattr(resp, 'ErrorResponse') and resp.ErrorResponse and resp.ErrorResponse.IsError: raise Exception(f"API Error: {resp.ErrorResponse.ErrorMessage}")
+                if hasattr(resp, 'SecurityResponse') and resp.SecurityResponse and not resp.SecurityResponse.Authorized: raise Exception(f"Auth Error: {resp.SecurityResponse.SecurityResult}")
+                if hasattr(resp, 'ServiceLocations') and resp.ServiceLocations and hasattr(resp.ServiceLocations, 'ServiceLocationData') and resp.ServiceLocations.ServiceLocationData:
+                    locations_data = resp.ServiceLocations.ServiceLocationData
+                    if not isinstance(locations_data, list): locations_data = [locations_data]
+                else: display_message("warning", f"No service locations returned for PracticeID {practice_id}.")
+            except Exception as e: display_message("error", f"Error loading service locations for PracticeID {practice_id}: {e}")
+        st.session_state[cache_key] = locations_data
+        return locations_data
+
+def get_location_index(client_obj, header_obj, practice_id, show_spinner=True):
+    # Built once per practice: normalized location Name -> ID. The first location with a given name wins,
+    # as with the old linear scan over the directory.
+    cache_key = f"locations_index_{practice_id}"
+    if cache_key in st.session_state: return st.session_state[cache_key]
+    locations_data = get_all_locations(client_obj, header_obj, practice_id, show_spinner=show_spinner)
+    with _directory_lock("locations", practice_id):
+        if cache_key in st.session_state: return st.session_state[cache_key]
+        location_index = {}
+        for loc in locations_data:
+            if not (hasattr(loc, 'Name') and loc.Name and hasattr(loc, 'ID') and loc.ID): continue
+            location_index.setdefault(loc.Name.strip().lower(), int(loc.ID))
+        if locations_data: st.session_state[cache_key] = location_index
+        return location_index
+
+def get_location_id_by_name(client_obj, header_obj, practice_id, location_name_to_find, show_spinner=True, messages=None):
     if not all([client_obj, header_obj, practice_id, location_name_to_find]): return None
     location_name = str(location_name_to_find).strip()
     if not location_name: return None
-    cache_key = f"location_id_{practice_id}_{location_name}"
+    location_lower = location_name.lower()
+    cache_key = f"location_id_{practice_id}_{location_lower}"
     if cache_key in st.session_state: return st.session_state[cache_key]
-    with st.spinner(f"Finding LocationID for '{location_name}'..."):
-        location_id = None
-        try:
-            req_type = client_obj.get_type('ns6:GetServiceLocationsReq')
-            filter_type = client_obj.get_type('ns6:ServiceLocationFilter')
-            fields_type = client_obj.get_type('ns6:ServiceLocationFieldsToReturn')
-            fields = fields_type(ID=True, Name=True, PracticeID=True)
-            loc_filter = filter_type(PracticeID=str(practice_id))
-            req = req_type(RequestHeader=header_obj, Filter=loc_filter, Fields=fields)
-            resp = client_obj.service.GetServiceLocations(request=req)
-            if hasattr(resp, 'ErrorResponse') and resp.ErrorResponse and resp.ErrorResponse.IsError: raise Exception(f"API Error: {resp.ErrorResponse.ErrorMessage}")
-            if hasattr(resp, 'SecurityResponse') and resp.SecurityResponse and not resp.SecurityResponse.Authorized: raise Exception(f"Auth Error: {resp.SecurityResponse.SecurityResult}")
-            
-            if hasattr(resp, 'ServiceLocations') and resp.ServiceLocations and hasattr(resp.ServiceLocations, 'ServiceLocationData') and resp.ServiceLocations.ServiceLocationData:
-                locations_data = resp.ServiceLocations.ServiceLocationData
-                if not isinstance(locations_data, list): locations_data = [locations_data]
-                location_obj = next((loc for loc in locations_data if hasattr(loc, 'Name') and loc.Name and loc.Name.strip().lower() == location_name.lower() and hasattr(loc, 'ID') and loc.ID), None)
-                if location_obj: location_id = int(location_obj.ID)
-                else: display_message("warning", f"Location '{location_name}' not found (case-insensitive name match).")
-            else: display_message("warning", f"No service locations returned for PracticeID {practice_id}.")
-        except Exception as e: display_message("error", f"Error GetLocationID for '{location_name}': {e}")
-        st.session_state[cache_key] = location_id
-        return location_id
-
-def get_primary_case_for_patient(client_obj, header_obj, patient_id_to_fetch):
+    location_id = None
+    location_index = get_location_index(client_obj, header_obj, practice_id, show_spinner=show_spinner)
+    if location_index:
+        location_id = location_index.get(location_lower)
+        if location_id is None: report_message("warning", f"Location '{location_name}' not found (case-insensitive name match).", messages)
+    st.session_state[cache_key] = location_id
+    return location_id
+
+def get_primary_case_for_patient(client_obj, header_obj, patient_id_to_fetch, show_spinner=True, messages=None):
     cache_key = f"patient_case_{patient_id_to_fetch}"
     if cache_key in st.session_state: return st.session_state[cache_key]
-    with st.spinner(f"Fetching Case info for Pt ID: {patient_id_to_fetch}..."):
+    with (st.spinner(f"Fetching Case info for Pt ID: {patient_id_to_fetch}...") if show_spinner else contextlib.nullcontext()):
         case_id_found = None
         try:
-            get_patient_req_type = client_obj.get_type('ns0:GetPatientReq')
-            filter_type = client_obj.get_type('ns0:SinglePatientFilter')
+            get_patient_req_type = get_wsdl_type(client_obj, 'ns0:GetPatientReq')
+            filter_type = get_wsdl_type(client_obj, 'ns0:SinglePatientFilter')
             p_filter = filter_type(PatientID=int(patient_id_to_fetch))
             request_data = get_patient_req_type(RequestHeader=header_obj, Filter=p_filter)
             api_response = client_obj.service.GetPatient(request=request_data)
@@ -281,88 +418,125 @@ def get_primary_case_for_patient(client_obj, header_obj, patient_id_to_fetch):
                api_response.Patient.Cases and hasattr(api_response.Patient.Cases, 'PatientCaseData') and api_response.Patient.Cases.PatientCaseData:
                 cases = api_response.Patient.Cases.PatientCaseData
                 if not isinstance(cases, list): cases = [cases]
-                primary = next((c for c in cases if hasattr(c, 'IsPrimaryCase') and ((isinstance(c.IsPrimaryCase, bool) and c.IsPrimaryCase) or (isinstance(c.IsPrimaryCase, str) and c.IsPrimaryCase.lower() == 'true')) and hasattr(c, 'PatientCaseID') and c.PatientCaseID), None)
+                primary = next((c for c in cases if _truthy(getattr(c, 'IsPrimaryCase', None)) and hasattr(c, 'PatientCaseID') and c.PatientCaseID), None)
                 if primary: case_id_found = int(primary.PatientCaseID)
                 elif cases and hasattr(cases[0], 'PatientCaseID') and cases[0].PatientCaseID : case_id_found = int(cases[0].PatientCaseID)
-        except Exception as e: display_message("error", f"Error fetching CaseID for Pt {patient_id_to_fetch}: {e}")
-        if case_id_found is None: display_message("warning", f"No usable case found via API for Patient ID {patient_id_to_fetch}. Charge entry will fail.")
+        except Exception as e: report_message("error", f"Error fetching CaseID for Pt {patient_id_to_fetch}: {e}", messages)
+        if case_id_found is None: report_message("warning", f"No usable case found via API for Patient ID {patient_id_to_fetch}. Charge entry will fail.", messages)
         st.session_state[cache_key] = case_id_found
         return case_id_found
 
+# --- Concurrent Lookup Prefetch ---
+# Runs func(item) for each unique item on worker threads with at most max_concurrency in flight; returns {item: result}.
+# Workers inherit the Streamlit script context so session_state caches and display_message keep working.
+def run_bounded_concurrently(func, items, max_concurrency=MAX_CONCURRENT_API_CALLS):
+    unique_items = list(dict.fromkeys(items))
+    if not unique_items: return {}
+    script_ctx = get_script_run_ctx()
+
+    def call_with_ctx(item):
+        if script_ctx: add_script_run_ctx(threading.current_thread(), script_ctx)
+        return func(item)
+
+    async def gather_bounded():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def bounded(item):
+            async with semaphore: return await asyncio.to_thread(call_with_ctx, item)
+        return await asyncio.gather(*(bounded(item) for item in unique_items))
+
+    return dict(zip(unique_items, asyncio.run(gather_bounded())))
+
+# Returns acquire(), which spaces calls at least 1/max_calls_per_sec apart across threads. A caller only sleeps
+# when it is ahead of schedule, so a run that never reaches the ceiling never waits.
+def make_rate_limiter(max_calls_per_sec):
+    interval = 1.0 / max_calls_per_sec
+    lock = threading.Lock()
+    next_slot = 0.0
+    def acquire():
+        nonlocal next_slot
+        with lock:
+            now = time.monotonic()
+            wait = next_slot - now
+            next_slot = max(now, next_slot) + interval
+        if wait > 0: time.sleep(wait)
+    return acquire
+
+# Resolves every unique provider, location and patient case in a preprocessed sheet up front, in parallel.
+# Results land in the usual st.session_state caches and are also returned as {value: id} maps.
+def prefetch_lookups(client_obj, header_obj, practice_id, df_excel_data):
+    # Rows without a usable Patient ID and From Date fail grouping whatever the lookups return, so they trigger no API calls
+    df_lookup = df_excel_data[df_excel_data[COL_PATIENT_ID_INT].notna() & df_excel_data[COL_API_FROM_DATE].notna()]
+    def unique_names(*cols): # Name columns arrive stripped with blanks as None
+        return pd.concat([df_lookup[c] for c in cols]).dropna().unique().tolist()
+
+    patient_ids = df_lookup[COL_PATIENT_ID_INT].unique().tolist()
+
+    tasks = [("provider", n) for n in unique_names(COL_RENDERING_PROVIDER, COL_SCHEDULING_PROVIDER)] + \
+            [("location", n) for n in unique_names(COL_LOCATION)] + \
+            [("case", p) for p in patient_ids]
+
+    lookup_messages = [] # (type, message) from every lookup, shown as one box per type below
+    def run_lookup(task):
+        kind, value = task
+        if kind == "provider": return get_provider_id_by_name(client_obj, header_obj, practice_id, value, show_spinner=False, messages=lookup_messages)
+        if kind == "location": return get_location_id_by_name(client_obj, header_obj, practice_id, value, show_spinner=False, messages=lookup_messages)
+        return get_primary_case_for_patient(client_obj, header_obj, value, show_spinner=False, messages=lookup_messages)
+
+    with st.spinner(f"Looking up {len(tasks)} unique providers, locations and patient cases..."):
+        results = run_bounded_concurrently(run_lookup, tasks)
+    for msg_type in ("error", "warning"):
+        batch = sorted(m for t, m in lookup_messages if t == msg_type)
+        if batch: display_message(msg_type, f"Lookup issues ({len(batch)}):<br>" + "<br>".join(batch))
+    lookups = {"provider": {}, "location": {}, "case": {}}
+    for (kind, value), found_id in results.items(): lookups[kind][value] = found_id
+    return lookups
+
 # --- Payload Creation Functions ---
-def create_patient_identifier_payload(c, p): return c.get_type('ns0:PatientIdentifierReq')(PatientID=int(p))
-def create_provider_identifier_payload(c, p): return c.get_type('ns0:ProviderIdentifierDetailedReq')(ProviderID=int(p))
-def create_service_location_payload(c, l): return c.get_type('ns0:EncounterServiceLocation')(LocationID=int(l))
-def create_practice_identifier_payload(c, p): return c.get_type('ns0:PracticeIdentifierReq')(PracticeID=int(p))
+def create_patient_identifier_payload(c, p): return get_wsdl_type(c, 'ns0:PatientIdentifierReq')(PatientID=int(p))
+def create_provider_identifier_payload(c, p): return get_wsdl_type(c, 'ns0:ProviderIdentifierDetailedReq')(ProviderID=int(p))
+def create_service_location_payload(c, l): return get_wsdl_type(c, 'ns0:EncounterServiceLocation')(LocationID=int(l))
+def create_practice_identifier_payload(c, p): return get_wsdl_type(c, 'ns0:PracticeIdentifierReq')(PracticeID=int(p))
 
-def create_place_of_service_payload(client_obj, pos_val_excel):
-    payload_type = client_obj.get_type('ns0:EncounterPlaceOfService')
+def create_place_of_service_payload(client_obj, pos_val_excel, messages=None):
+    payload_type = get_wsdl_type(client_obj, 'ns0:EncounterPlaceOfService')
     code, name = None, None
     if pd.isna(pos_val_excel) or not str(pos_val_excel).strip(): 
-        display_message("warning", "Place of Service value is blank in Excel. Cannot create POS payload.")
+        report_message("warning", "Place of Service value is blank in Excel. Cannot create POS payload.", messages)
         return None
     norm_pos_input = str(pos_val_excel).strip()
     norm_pos_upper = norm_pos_input.upper()
 
-    if norm_pos_upper in POS_CODE_MAP:
-        code = POS_CODE_MAP[norm_pos_upper]["code"]
-        name = POS_CODE_MAP[norm_pos_upper]["name"]
+    pos_entry = POS_CODE_MAP.get(norm_pos_upper)
+    if pos_entry:
+        code, name = pos_entry["code"], pos_entry["name"]
     elif norm_pos_input.isdigit() and len(norm_pos_input) <= 2:
         code = norm_pos_input
-        name = next((d["name"] for _, d in POS_CODE_MAP.items() if d["code"] == code), norm_pos_input) 
+        name = POS_NAME_BY_CODE.get(code, norm_pos_input)
     else:
-        display_message("error", f"POS value '{norm_pos_input}' is not in standard map and not a valid 2-digit code format.")
+        report_message("error", f"POS value '{norm_pos_input}' is not in standard map and not a valid 2-digit code format.", messages)
         return None
         
     if not code: return None 
     try: return payload_type(PlaceOfServiceCode=str(code), PlaceOfServiceName=str(name))
     except Exception:
         try: return payload_type(PlaceOfServiceCode=str(code))
-        except Exception as e2: display_message("error", f"POS Payload Error: {e2}"); return None
+        except Exception as e2: report_message("error", f"POS Payload Error: {e2}", messages); return None
 
-def create_service_line_payload(client_obj, sld, start_dt_api_str, end_dt_api_str):
-    slt = client_obj.get_type('ns0:ServiceLineReq')
-    pc = str(sld.get(COL_PROCEDURES, "")).strip()
-    u = sld.get(COL_UNITS)
-    d1_val = sld.get(COL_DIAG1) 
+# Columns read by create_service_line_payload, handed over as {column: ndarray} so each line is read by row position
+SERVICE_LINE_COLUMNS = [COL_PROCEDURES, COL_UNITS, COL_MOD1, COL_MOD2, COL_DIAG1, COL_DIAG2, COL_DIAG3, COL_DIAG4]
 
-    row_num_for_log = sld.get('original_excel_row_num', 'N/A')
+def create_service_line_payload(client_obj, sl_cols, row_pos, start_dt_api_str, end_dt_api_str, messages=None):
+    # sl_cols holds preprocess_dataframe() output: codes are stripped with blanks as None and Units parsed into COL_UNITS_NUMERIC.
+    # Rows with a COL_LINE_ERROR were already rejected up front, so the values here are known to be usable.
+    slt = get_wsdl_type(client_obj, 'ns0:ServiceLineReq')
+    pc = sl_cols[COL_PROCEDURES][row_pos]
+    uf = float(sl_cols[COL_UNITS_NUMERIC][row_pos])
+    d1_cleaned = sl_cols[COL_DIAG1][row_pos]
 
-    if not pc: 
-        display_message("warning", f"Row {row_num_for_log}: Procedure code missing. SvcLine not created.")
-        return None
-    if u is None or pd.isna(u) or str(u).strip() == "":
-        display_message("warning", f"Row {row_num_for_log} (Proc {pc}): Units missing or blank. SvcLine not created.")
-        return None
-    if d1_val is None or pd.isna(d1_val) or not str(d1_val).strip():
-        display_message("warning", f"Row {row_num_for_log} (Proc {pc}): Diag1 missing or blank. SvcLine not created.")
-        return None
-    
-    try: 
-        uf = float(u)
-        if uf <= 0: 
-            display_message("warning", f"Row {row_num_for_log} (Proc {pc}): Units must be > 0. Value: {uf}. SvcLine not created.")
-            return None
-    except ValueError: 
-        display_message("warning", f"Row {row_num_for_log} (Proc {pc}): Units '{u}' not valid number. SvcLine not created.")
-        return None
-    
-    def clean_val(val, is_modifier=False, is_diag=False):
-        s_val = str(val if pd.notna(val) else "").strip()
-        if is_modifier:
-            if s_val.endswith(".0"): s_val = s_val[:-2]
-            if s_val and len(s_val) > 2 :
-                 display_message("warning", f"Row {row_num_for_log} (Proc {pc}): Modifier '{s_val}' is longer than 2 characters. Using first 2: '{s_val[:2]}'.")
-                 s_val = s_val[:2]
-        return s_val if s_val and s_val.lower() != 'nan' else None
-
-    m1 = clean_val(sld.get(COL_MOD1), is_modifier=True)
-    m2 = clean_val(sld.get(COL_MOD2), is_modifier=True)
-    d1_cleaned = clean_val(d1_val, is_diag=True) 
-
-    if not d1_cleaned: 
-        display_message("warning", f"Row {row_num_for_log} (Proc {pc}): Diag1 became invalid after cleaning. SvcLine not created.")
-        return None
+    row_num_for_log = sl_cols['original_excel_row_num'][row_pos]
+
+    m1 = sl_cols[COL_MOD1][row_pos]
+    m2 = sl_cols[COL_MOD2][row_pos]
 
     args = {
         'ProcedureCode': pc, 'Units': uf, 
@@ -373,9 +547,9 @@ def create_service_line_payload(client_obj, sld, start_dt_api_str, end_dt_api_st
     if m1: args['ProcedureModifier1'] = m1
     if m2: args['ProcedureModifier2'] = m2
     
-    diag2 = clean_val(sld.get(COL_DIAG2), is_diag=True); 
-    diag3 = clean_val(sld.get(COL_DIAG3), is_diag=True); 
-    diag4 = clean_val(sld.get(COL_DIAG4), is_diag=True)
+    diag2 = sl_cols[COL_DIAG2][row_pos]
+    diag3 = sl_cols[COL_DIAG3][row_pos]
+    diag4 = sl_cols[COL_DIAG4][row_pos]
     
     if diag2: args['DiagnosisCode2'] = diag2
     if diag3: args['DiagnosisCode3'] = diag3
@@ -383,79 +557,287 @@ def create_service_line_payload(client_obj, sld, start_dt_api_str, end_dt_api_st
     
     try: return slt(**args)
     except Exception as e: 
-        display_message("error", f"SvcLine Payload Error for Proc {pc} (Row {row_num_for_log}): {e} with args {args}")
+        report_message("error", f"SvcLine Payload Error for Proc {pc} (Row {row_num_for_log}): {e} with args {args}", messages)
         return None
 
 # --- XML Error Parsing Function ---
+# Compiled once; a failing batch runs the parser once per group. The regexes are the fallback for messages
+# that are not well-formed XML; normal messages are read in a single ElementTree pass.
+_SERVICE_LINE_RE = re.compile(r"<ServiceLine>(.*?)</ServiceLine>", re.DOTALL)
+_DIAG_ERROR_RE = re.compile(r"<DiagnosisCode(?P<diag_num>\d)>(?P<diag_code_val>[^<]+?)<err id=\"\d+\">(?P<err_msg>[^<]+)</err>")
+_MOD_ERROR_RE = re.compile(r"<ProcedureModifier(?P<mod_num>\d)>(?P<mod_code_val>[^<]+?)<err id=\"\d+\">(?P<err_msg>[^<]+)</err>")
+_PROC_CODE_RE = re.compile(r"<ProcedureCode>(?P<proc_code_val>[^<]+)</ProcedureCode>")
+_ENCOUNTER_ERROR_RE = re.compile(r'<err id="6100">(.*?)</err>')
+_LINE_FIELD_TAG_RE = re.compile(r"(DiagnosisCode|ProcedureModifier)(\d)")
+
+def _format_line_error(line_no, proc_code, field_kind, field_num, field_val, err_msg):
+    simple_msg = err_msg.split(',')[0].strip()
+    if field_kind == "DiagnosisCode": return f"L{line_no} (Proc {proc_code}): Diag {field_num} ('{field_val}') - {simple_msg}."
+    error_text = f"L{line_no} (Proc {proc_code}): Mod {field_num} ('{field_val}') - {simple_msg}."
+    if ".0" in field_val: error_text += " (Note: Modifiers should be 2 chars, e.g., '59' not '59.0')."
+    return error_text
+
+def _local_name(el):
+    return el.tag.rpartition('}')[2] # '{namespace}ServiceLine' -> 'ServiceLine'; plain tags pass through
+
+# Both return (line errors, encounter-level 6100 message or None); per line, diagnosis errors come before modifier errors
+def _tebra_errors_from_tree(root):
+    line_errors = []
+    for line_no, sl in enumerate((el for el in root.iter() if _local_name(el) == 'ServiceLine'), 1):
+        proc_code = next((c.text for c in sl if _local_name(c) == 'ProcedureCode'), None) or "N/A"
+        flagged = []
+        for field in sl:
+            tag_match = _LINE_FIELD_TAG_RE.fullmatch(_local_name(field))
+            err = next((c for c in field if _local_name(c) == 'err'), None) if tag_match else None
+            if err is None or not field.text or not err.text: continue
+            flagged.append((tag_match.group(1) != "DiagnosisCode", tag_match.group(1), tag_match.group(2), field.text, err.text))
+        for _, kind, num, val, msg in sorted(flagged, key=lambda f: f[0]): line_errors.append(_format_line_error(line_no, proc_code, kind, num, val, msg))
+    enc_err = next((e for e in root.iter() if _local_name(e) == 'err' and e.get('id') == "6100"), None)
+    return line_errors, None if enc_err is None else (enc_err.text or "")
+
+def _tebra_errors_from_regex(xml_string):
+    line_errors = []
+    for line_no, sl_xml_content in enumerate(_SERVICE_LINE_RE.findall(xml_string), 1):
+        proc_match = _PROC_CODE_RE.search(sl_xml_content)
+        proc_code = proc_match.group("proc_code_val") if proc_match else "N/A"
+        for match in _DIAG_ERROR_RE.finditer(sl_xml_content):
+            line_errors.append(_format_line_error(line_no, proc_code, "DiagnosisCode", match['diag_num'], match['diag_code_val'], match['err_msg']))
+        for match in _MOD_ERROR_RE.finditer(sl_xml_content):
+            line_errors.append(_format_line_error(line_no, proc_code, "ProcedureModifier", match['mod_num'], match['mod_code_val'], match['err_msg']))
+    enc_match = _ENCOUNTER_ERROR_RE.search(xml_string)
+    return line_errors, enc_match.group(1) if enc_match else None
+
+# Memoized on the message text: a batch failing for the same reason (credentials, a shared bad code) returns the
+# same envelope for every group. The context arguments do not affect the result, so callers leave them out.
+@functools.lru_cache(maxsize=256)
 def parse_and_simplify_tebra_xml_error(xml_string, patient_id_context="N/A", dos_context="N/A"):
     if not xml_string or not isinstance(xml_string, str) or "<Encounter" not in xml_string :
         return xml_string 
 
-    simplified_errors = []
     try:
         if xml_string.startswith("API Error: "):
             xml_string = xml_string[len("API Error: "):].strip()
-        
-        service_line_pattern = r"<ServiceLine>(.*?)</ServiceLine>"
-        diag_error_pattern = r"<DiagnosisCode(?P<diag_num>\d)>(?P<diag_code_val>[^<]+?)<err id=\"\d+\">(?P<err_msg>[^<]+)</err>"
-        mod_error_pattern = r"<ProcedureModifier(?P<mod_num>\d)>(?P<mod_code_val>[^<]+?)<err id=\"\d+\">(?P<err_msg>[^<]+)</err>"
-        proc_code_pattern = r"<ProcedureCode>(?P<proc_code_val>[^<]+)</ProcedureCode>"
 
-        service_lines_xml = re.findall(service_line_pattern, xml_string, re.DOTALL)
-        
-        sl_counter_for_log = 0
-        for sl_xml_content in service_lines_xml:
-            sl_counter_for_log += 1 
-            proc_code = "N/A"
-            proc_match = re.search(proc_code_pattern, sl_xml_content)
-            if proc_match:
-                proc_code = proc_match.group("proc_code_val")
-
-            for match in re.finditer(diag_error_pattern, sl_xml_content):
-                group_dict = match.groupdict()
-                simple_msg = group_dict['err_msg'].split(',')[0].strip() 
-                simplified_errors.append(f"L{sl_counter_for_log} (Proc {proc_code}): Diag {group_dict['diag_num']} ('{group_dict['diag_code_val']}') - {simple_msg}.")
-            
-            for match in re.finditer(mod_error_pattern, sl_xml_content):
-                group_dict = match.groupdict()
-                simple_msg = group_dict['err_msg'].split(',')[0].strip()
-                mod_val = group_dict['mod_code_val']
-                error_text = f"L{sl_counter_for_log} (Proc {proc_code}): Mod {group_dict['mod_num']} ('{mod_val}') - {simple_msg}."
-                if ".0" in mod_val:
-                    error_text += " (Note: Modifiers should be 2 chars, e.g., '59' not '59.0')."
-                simplified_errors.append(error_text)
-
-        overall_encounter_error_match = re.search(r'<err id="6100">(.*?)</err>', xml_string)
-        if overall_encounter_error_match :
+        try: simplified_errors, overall_encounter_error = _tebra_errors_from_tree(ET.fromstring(xml_string))
+        except ET.ParseError: simplified_errors, overall_encounter_error = [], None
+        if not simplified_errors and overall_encounter_error is None: # Not well-formed, or a shape the tree walk doesn't know
+            simplified_errors, overall_encounter_error = _tebra_errors_from_regex(xml_string)
+
+        if overall_encounter_error is not None:
             if not simplified_errors: # Only add general if no specific line errors found
-                 simplified_errors.append(f"Encounter Creation Failed: {overall_encounter_error_match.group(1).strip()}.")
+                 simplified_errors.append(f"Encounter Creation Failed: {overall_encounter_error.strip()}.")
 
         if not simplified_errors and xml_string.startswith("<Encounter"): 
             simplified_errors.append("Encounter creation failed. No specific line errors parsed. Review raw API response.")
         elif not simplified_errors: 
             return xml_string 
 
-        return "; ".join(list(set(simplified_errors))) if simplified_errors else "Encounter processing failed with unspecified service line errors."
+        return "; ".join(dict.fromkeys(simplified_errors)) if simplified_errors else "Encounter processing failed with unspecified service line errors."
         
     except Exception as e_parse:
         return "Error simplifying API message. Original: " + xml_string[:300] + "..."
 
 
+# --- Excel Input ---
+EXCEL_READ_CHUNK_ROWS = 5000
+_EXCEL_BLANK = float('nan')
+
+def _excel_cell_to_str(value):
+    # Mirrors pd.read_excel(dtype=str): blanks become NaN, whole-number floats lose their '.0'
+    if value is None or value == "": return _EXCEL_BLANK # calamine reports empty cells as ""
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    elif type(value) is datetime.date: value = datetime.datetime.combine(value, datetime.time()) # calamine gives midnight dates as date; keep openpyxl's text
+    return str(value)
+
+def _calamine_workbook_cls():
+    try:
+        from python_calamine import CalamineWorkbook, CalamineSheet
+    except ImportError:
+        return None
+    # iter_rows arrived in python-calamine 0.2.3; an older install falls back to openpyxl instead of raising mid-read
+    if not (hasattr(CalamineSheet, 'iter_rows') and hasattr(CalamineSheet, 'start')): return None
+    return CalamineWorkbook
+
+@contextlib.contextmanager
+def _first_sheet_rows(uploaded_file):
+    # python-calamine parses the sheet XML in Rust, several times faster than openpyxl; it is optional, so
+    # openpyxl read_only (already a requirement) is the fallback. Yields an iterator of row value sequences.
+    CalamineWorkbook = _calamine_workbook_cls()
+    if CalamineWorkbook is not None:
+        if hasattr(uploaded_file, 'seek'): uploaded_file.seek(0)
+        sheet = CalamineWorkbook.from_filelike(uploaded_file).get_sheet_by_index(0)
+        # calamine's rows begin at the first used column (sheet.start is (row, col), None when empty); openpyxl's
+        # begin at column A, so blank leading columns are padded back in and both readers give the same frame.
+        lead = [""] * sheet.start[1] if sheet.start else []
+        yield (lead + row for row in sheet.iter_rows()) if lead else sheet.iter_rows()
+        return
+    import openpyxl
+    wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try: yield wb.worksheets[0].iter_rows(values_only=True)
+    finally: wb.close()
+
+def _dedupe_columns(columns):
+    # Same renaming as pd.read_excel: repeats of 'X' become 'X.1', 'X.2', ..., skipping names the header already has
+    columns, counts = list(columns), defaultdict(int)
+    for i, col in enumerate(columns):
+        base, cur_count = col, counts[col]
+        while cur_count > 0:
+            counts[base] = cur_count + 1
+            col = f"{base}.{cur_count}"
+            cur_count = cur_count + 1 if col in columns else counts[col]
+        columns[i] = col; counts[col] = cur_count + 1
+    return columns
+
+def _records_frame(rows):
+    # Pads a chunk's rows to its widest row; columns stay positional until read_excel_streaming names them
+    width = max(len(r) for r in rows)
+    return pd.DataFrame.from_records([r + [_EXCEL_BLANK] * (width - len(r)) for r in rows])
+
+def read_excel_streaming(uploaded_file):
+    # Rows are streamed from the first sheet instead of building the whole workbook in memory, then
+    # materialized into DataFrames chunk by chunk with every cell kept as text, like read_excel(dtype=str).
+    # As there, the frame is as wide as the rightmost non-blank cell in any row, header or not.
+    with _first_sheet_rows(uploaded_file) as rows_iter:
+        header = next(rows_iter, None)
+        if header is None: return pd.DataFrame()
+        header = [_excel_cell_to_str(h) for h in header]
+        while header and header[-1] is _EXCEL_BLANK: header.pop()
+        n_cols = len(header)
+        chunks, chunk, pending_blank = [], [], []
+        for row in rows_iter:
+            values = [_excel_cell_to_str(v) for v in row]
+            while values and values[-1] is _EXCEL_BLANK: values.pop() # Formatted-but-empty cells past the data
+            if not values:
+                pending_blank.append(values) # Only kept if a non-blank row follows, so trailing blanks are dropped
+                continue
+            n_cols = max(n_cols, len(values))
+            chunk.extend(pending_blank); pending_blank = []
+            chunk.append(values)
+            if len(chunk) >= EXCEL_READ_CHUNK_ROWS:
+                chunks.append(_records_frame(chunk)); chunk = []
+        if chunk: chunks.append(_records_frame(chunk))
+    header += [_EXCEL_BLANK] * (n_cols - len(header))
+    columns = _dedupe_columns([h.strip() if h is not _EXCEL_BLANK else f"Unnamed: {i}" for i, h in enumerate(header)])
+    if not chunks: return pd.DataFrame(columns=columns, dtype=object)
+    df = pd.concat(chunks, ignore_index=True).reindex(columns=range(n_cols)).astype(object)
+    df.columns = columns
+    return df
+
+# --- Excel Output ---
+def write_results_excel(df, sheet_name='ChargeEntryResults'):
+    # xlsxwriter's constant_memory mode flushes each row to a temp file as soon as the next row starts, so peak memory
+    # stays at one row. pandas' to_excel emits cells column by column, which that mode would silently truncate,
+    # so rows are written directly; the header keeps pandas' bold, bordered, centered look.
+    import xlsxwriter
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(sheet_name)
+    header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    worksheet.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+    for row_num, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_num, 0, [None if pd.isna(v) else v for v in row])
+    workbook.close()
+    return output.getvalue()
+
+# --- Input Preprocessing ---
+API_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+COL_API_FROM_DATE = '_api_from_date'; COL_API_THROUGH_DATE = '_api_through_date'; COL_UNITS_NUMERIC = '_units'
+COL_PATIENT_ID_INT = '_patient_id'; COL_CASE_ID = '_case_id'; COL_POS_VALUE = '_pos_value'
+COL_LINE_ERROR = '_line_error' # Reason the row cannot become a service line, None when valid
+_MODIFIER_FLOAT_SUFFIX_RE = re.compile(r"\.0$") # Numeric modifiers like 25 come back from Excel as '25.0'
+
+def _clean_text_column(series):
+    # Vectorized strip; blank and literal 'nan' cells become None
+    cleaned = series.astype("string").str.strip()
+    cleaned = cleaned.mask(cleaned.eq("") | cleaned.str.lower().eq("nan"))
+    return cleaned.astype(object).where(cleaned.notna(), None)
+
+def _to_api_datetime_column(series):
+    # The column holds the reader's text (or blanks). Sheets repeat the same few dates across many lines,
+    # so each distinct value is parsed once and mapped back.
+    text_vals = list(series.dropna().unique())
+    api_strings = {}
+    try:
+        with warnings.catch_warnings(): # pandas 2.x warns, then returns objects, on mixed time zones; newer pandas raises
+            warnings.filterwarnings("error", message=".*mixed time zones.*", category=FutureWarning)
+            parsed = pd.to_datetime(pd.Series(text_vals, dtype=object), errors='coerce', format='mixed')
+    except (FutureWarning, ValueError, TypeError): parsed = None
+    if parsed is not None and pd.api.types.is_datetime64_any_dtype(parsed): text_strings = parsed.dt.strftime(API_DATETIME_FORMAT).astype(object).where(parsed.notna(), None)
+    else: # tz-aware text mixed with naive (or with other offsets) parses to plain objects without .dt; parse each value alone
+        per_value = (pd.to_datetime(v, errors='coerce') for v in text_vals)
+        text_strings = [ts.strftime(API_DATETIME_FORMAT) if pd.notna(ts) else None for ts in per_value]
+    api_strings.update(zip(text_vals, text_strings))
+    result = series.map(api_strings).astype(object)
+    return result.where(result.notna(), None)
+
+def preprocess_dataframe(df_excel_data):
+    # Column-level parsing/cleaning done once up front so the per-line payload builder only reads clean values.
+    # Returns a working copy; the caller's DataFrame (used for the results output) is left untouched.
+    df_work = df_excel_data.copy()
+    warnings_list = []
+    row_nums = df_work['original_excel_row_num'] if 'original_excel_row_num' in df_work.columns else df_work.index + 2
+
+    for src_col, api_col in ((COL_FROM_DATE, COL_API_FROM_DATE), (COL_THROUGH_DATE, COL_API_THROUGH_DATE)):
+        df_work[api_col] = _to_api_datetime_column(df_work[src_col])
+        raw_present = _clean_text_column(df_work[src_col]).notna()
+        for row_num, raw_val in zip(row_nums[raw_present & df_work[api_col].isna()], df_work.loc[raw_present & df_work[api_col].isna(), src_col]):
+            warnings_list.append(f"Row {row_num}: Date parse warning for '{src_col}': '{raw_val}'. Using None.")
+
+    pid_map = {}
+    for pid_val in df_work[COL_PATIENT_ID].dropna().unique():
+        try: pid_map[pid_val] = int(pid_val)
+        except (TypeError, ValueError): continue
+    df_work[COL_PATIENT_ID_INT] = pd.Series([pid_map.get(v) for v in df_work[COL_PATIENT_ID]], index=df_work.index, dtype=object)
+
+    df_work[COL_UNITS_NUMERIC] = pd.to_numeric(df_work[COL_UNITS], errors='coerce')
+    df_work[COL_PROCEDURES] = _clean_text_column(df_work[COL_PROCEDURES])
+    for text_col in (COL_RENDERING_PROVIDER, COL_SCHEDULING_PROVIDER, COL_LOCATION, COL_BATCH_NUMBER):
+        df_work[text_col] = _clean_text_column(df_work[text_col])
+    for diag_col in (COL_DIAG1, COL_DIAG2, COL_DIAG3, COL_DIAG4):
+        df_work[diag_col] = _clean_text_column(df_work[diag_col])
+    for mod_col in (COL_MOD1, COL_MOD2):
+        mods = _clean_text_column(df_work[mod_col].astype("string").str.strip().str.replace(_MODIFIER_FLOAT_SUFFIX_RE, "", regex=True))
+        too_long = mods.str.len().gt(2).fillna(False).astype(bool)
+        for row_num, proc, mod_val in zip(row_nums[too_long], df_work.loc[too_long, COL_PROCEDURES], mods[too_long]):
+            warnings_list.append(f"Row {row_num} (Proc {proc}): Modifier '{mod_val}' is longer than 2 characters. Using first 2: '{mod_val[:2]}'.")
+        df_work[mod_col] = mods.where(~too_long, mods.str[:2])
+
+    # Service-line validation as one mask per rule; the first failing rule (in the order below) is the row's reason
+    units_blank = _clean_text_column(df_work[COL_UNITS]).isna()
+    line_checks = [
+        (df_work[COL_PROCEDURES].isna(), "Procedure code missing"),
+        (df_work[COL_UNITS_NUMERIC].isna() & units_blank, "Units missing or blank"),
+        (df_work[COL_DIAG1].isna(), "Diag1 missing or blank"),
+        (df_work[COL_UNITS_NUMERIC].isna(), "Units not valid number"),
+        (df_work[COL_UNITS_NUMERIC].le(0), "Units must be > 0"),
+    ]
+    line_error = pd.Series([None] * len(df_work), index=df_work.index, dtype=object)
+    for mask, reason in reversed(line_checks): line_error[mask] = reason
+    df_work[COL_LINE_ERROR] = line_error
+    invalid = line_error.notna()
+    for row_num, proc, units_raw, reason in zip(row_nums[invalid], df_work.loc[invalid, COL_PROCEDURES], df_work.loc[invalid, COL_UNITS], line_error[invalid]):
+        warnings_list.append(f"Row {row_num} (Proc {proc or 'N/A'}, Units '{units_raw}'): {reason}. SvcLine not created.")
+
+    # Place of Service falls back to Encounter Mode when blank
+    df_work[COL_POS_VALUE] = _clean_text_column(df_work[COL_PLACE_OF_SERVICE_EXCEL]).fillna(_clean_text_column(df_work[COL_ENCOUNTER_MODE]))
+
+    if warnings_list: display_message("warning", "Issues found while preparing rows:<br>" + "<br>".join(warnings_list))
+    return df_work
+
+
 # --- Main Processing Logic (MODIFIED for DOS Grouping and Error Simplification) ---
 def process_excel_data(client_obj, header_obj, current_practice_id, df_excel_data):
-    df_results = df_excel_data.copy()
-    df_results['Charge Entry Status'] = "Pending" 
-    df_results[COL_RESULT_MESSAGE] = "" 
+    # df_results (the input plus the two result columns) is only built when the function returns, so no second
+    # full copy of the sheet is held while the groups run; outcomes live in status_arr/reason_arr until then.
 
     try:
-        enc_type = client_obj.get_type('ns0:EncounterCreate')
-        create_req_type = client_obj.get_type('ns0:CreateEncounterReq')
-        case_id_type = client_obj.get_type('ns0:PatientCaseIdentifierReq') 
-        arr_sl_req_type = client_obj.get_type('ns0:ArrayOfServiceLineReq')
+        enc_type = get_wsdl_type(client_obj, 'ns0:EncounterCreate')
+        create_req_type = get_wsdl_type(client_obj, 'ns0:CreateEncounterReq')
+        case_id_type = get_wsdl_type(client_obj, 'ns0:PatientCaseIdentifierReq') 
+        arr_sl_req_type = get_wsdl_type(client_obj, 'ns0:ArrayOfServiceLineReq')
     except Exception as e:
         display_message("error", f"Fatal WSDL Type Error: {e}. Cannot process.")
-        df_results['Charge Entry Status'] = "Failed"
-        df_results[COL_RESULT_MESSAGE] = f"WSDL Type Error: {e}"
+        df_results = df_excel_data.assign(**{'Charge Entry Status': "Failed", COL_RESULT_MESSAGE: f"WSDL Type Error: {e}"})
         # Define expected output columns for consistent error output
         output_columns = df_excel_data.columns.tolist() + ['original_excel_row_num', 'Charge Entry Status', COL_RESULT_MESSAGE]
         # Remove duplicates while preserving order
@@ -465,64 +847,58 @@ def process_excel_data(client_obj, header_obj, current_practice_id, df_excel_dat
         return df_results.reindex(columns=output_columns).fillna(''), 0, 0
 
 
-    keys_to_clear = [k for k in st.session_state if k.startswith("provider_id_") or k.startswith("location_id_") or k.startswith("patient_case_")]
-    for k in keys_to_clear: 
-        if k in st.session_state: del st.session_state[k]
+    df_work = preprocess_dataframe(df_excel_data)
+    lookups = prefetch_lookups(client_obj, header_obj, current_practice_id, df_work)
+    # One GetPatient per distinct patient already ran in the prefetch; attach its case to every row in one pass
+    df_work[COL_CASE_ID] = pd.Series([lookups["case"].get(pid) for pid in df_work[COL_PATIENT_ID_INT]], index=df_work.index, dtype=object)
+
+    # Service-line fields as column arrays (SoA); groups keep row positions into them instead of per-row dicts
+    sl_cols = {col: df_work[col].to_numpy(dtype=object) for col in SERVICE_LINE_COLUMNS + [COL_UNITS_NUMERIC, COL_LINE_ERROR, 'original_excel_row_num']}
+    # Encounter-level fields the same way; a group reads them at its first row position
+    enc_cols = {col: df_work[col].to_numpy(dtype=object) for col in (COL_PATIENT_ID_INT, COL_CASE_ID, COL_API_FROM_DATE, COL_API_THROUGH_DATE,
+                                                                     COL_RENDERING_PROVIDER, COL_SCHEDULING_PROVIDER, COL_LOCATION,
+                                                                     COL_BATCH_NUMBER, COL_POS_VALUE, 'original_excel_row_num')}
 
-    grouped_charges = defaultdict(lambda: {'encounter_details_source_row_dict': None, 
-                                           'service_lines_data_list': [], 
-                                           'original_df_indices': []})
-    
     display_message("info", "Grouping Excel Rows by Patient, From Date (DOS), and Case...")
-    pb_group = st.progress(0)
     grouping_warnings = []
 
-    for df_idx, row_series in df_excel_data.iterrows():
-        pb_group.progress((df_idx + 1) / len(df_excel_data))
-        
-        pid_val = row_series.get(COL_PATIENT_ID)
-        from_date_val = row_series.get(COL_FROM_DATE) 
-
-        current_row_grouping_status, current_row_grouping_reason = "Failed to Group", ""
+    # Grouping-stage checks as column masks; a row keeps the reason of the first rule it fails (same order as before)
+    pid_text, dos_text = df_work[COL_PATIENT_ID].astype(str), df_work[COL_FROM_DATE].astype(str)
+    group_rules = [
+        (_clean_text_column(df_work[COL_PATIENT_ID]).isna(), f"'{COL_PATIENT_ID}' is missing."),
+        (_clean_text_column(df_work[COL_FROM_DATE]).isna(), f"'{COL_FROM_DATE}' (Date of Service) is missing for grouping."),
+        (df_work[COL_PATIENT_ID_INT].isna() | df_work[COL_API_FROM_DATE].isna(), f"Invalid format for '{COL_PATIENT_ID}' ('" + pid_text + f"') or '{COL_FROM_DATE}' ('" + dos_text + "')."),
+        (df_work[COL_CASE_ID].isna(), "No existing Tebra case found for Patient ID " + df_work[COL_PATIENT_ID_INT].astype(str) + "."),
+    ]
+    # Messages are built column-wise (str concatenation) and applied last-rule-first so the earliest failing rule wins
+    group_fail_reason = pd.Series([None] * len(df_work), index=df_work.index, dtype=object)
+    for mask, reason in reversed(group_rules): group_fail_reason = group_fail_reason.mask(mask, reason)
+
+    # Per-row outcome kept in two positional arrays and attached to the input once, when df_results is built
+    status_arr = np.full(len(df_work), "Pending", dtype=object)
+    reason_arr = np.full(len(df_work), "", dtype=object)
+    group_failed = group_fail_reason.notna().to_numpy()
+    if group_failed.any():
+        status_arr[group_failed] = "Failed"
+        reason_arr[group_failed] = group_fail_reason[group_failed].to_numpy()
+        grouping_warnings = ("Row " + df_work.loc[group_failed, 'original_excel_row_num'].astype(str) + ": " + group_fail_reason[group_failed]).tolist()
+
+    # One encounter per (patient, DOS, case). groupby(...).indices gives each group's row positions as a numpy array
+    # in one C pass; groups are ordered by their first row so they keep the sheet's first-appearance order.
+    # A group is just its row positions; its first row supplies the encounter-level fields from enc_cols.
+    groupable_pos = np.flatnonzero(~group_failed)
+    df_groupable = df_work.iloc[groupable_pos].assign(_dos_key=lambda d: d[COL_API_FROM_DATE].str[:10])
+    group_indices = df_groupable.groupby([COL_PATIENT_ID_INT, '_dos_key', COL_CASE_ID], sort=False).indices
+    valid_groups_to_process = {} # Every group formed here has its source row, so no separate "valid" filtering pass
+    for local_positions in sorted(group_indices.values(), key=lambda a: a[0]):
+        row_positions = groupable_pos[local_positions] # Positions in df_groupable mapped back to df_work rows
+        first_pos = row_positions[0]
+        # Key values read from the object arrays, since the groupby keys are numpy scalars
+        grp_key = (enc_cols[COL_PATIENT_ID_INT][first_pos], enc_cols[COL_API_FROM_DATE][first_pos][:10], enc_cols[COL_CASE_ID][first_pos])
+        valid_groups_to_process[grp_key] = {'row_positions': row_positions}
 
-        if pd.isna(pid_val) or str(pid_val).strip() == "":
-            current_row_grouping_reason = f"'{COL_PATIENT_ID}' is missing."
-        elif pd.isna(from_date_val) or str(from_date_val).strip() == "": 
-            current_row_grouping_reason = f"'{COL_FROM_DATE}' (Date of Service) is missing for grouping."
-        else:
-            try:
-                pid_grp = int(pid_val)
-                from_date_str_key = pd.to_datetime(from_date_val).strftime('%Y-%m-%d')
-            except ValueError:
-                current_row_grouping_reason = f"Invalid format for '{COL_PATIENT_ID}' ('{pid_val}') or '{COL_FROM_DATE}' ('{from_date_val}')."
-            except Exception as e_date_parse: 
-                 current_row_grouping_reason = f"Error parsing '{COL_FROM_DATE}' ('{from_date_val}') for grouping key: {e_date_parse}."
-            else:
-                cid_for_group = get_primary_case_for_patient(client_obj, header_obj, pid_grp)
-                if not cid_for_group:
-                    current_row_grouping_reason = f"No existing Tebra case found for Patient ID {pid_grp}."
-                else:
-                    current_row_grouping_status = "Grouped Successfully"
-                    grp_key = (pid_grp, from_date_str_key, cid_for_group) 
-                    
-                    row_dict_for_group = row_series.to_dict()
-                    row_dict_for_group['original_excel_row_num'] = df_excel_data.loc[df_idx, 'original_excel_row_num']
-                    
-                    if not grouped_charges[grp_key]['encounter_details_source_row_dict']:
-                        grouped_charges[grp_key]['encounter_details_source_row_dict'] = row_dict_for_group
-                    grouped_charges[grp_key]['service_lines_data_list'].append(row_dict_for_group) 
-                    grouped_charges[grp_key]['original_df_indices'].append(df_idx) 
-        
-        if current_row_grouping_status == "Failed to Group":
-             df_results.loc[df_idx, 'Charge Entry Status'] = "Failed"
-             df_results.loc[df_idx, COL_RESULT_MESSAGE] = current_row_grouping_reason
-             grouping_warnings.append(f"Row {row_series.get('original_excel_row_num', df_idx+2)}: {current_row_grouping_reason}")
-    
-    pb_group.empty()
     if grouping_warnings: display_message("warning", "Issues during grouping stage:<br>" + "<br>".join(grouping_warnings))
 
-    valid_groups_to_process = {k: v for k, v in grouped_charges.items() if v['encounter_details_source_row_dict'] is not None}
-
     display_message("info", f"Processing {len(valid_groups_to_process)} unique encounter groups...")
     
     proc_grp_cnt = 0
@@ -535,49 +911,72 @@ def process_excel_data(client_obj, header_obj, current_practice_id, df_excel_dat
          # Ensure consistent output columns even if no groups processed
          final_cols_on_no_groups = df_excel_data.columns.tolist() + ['original_excel_row_num', 'Charge Entry Status', COL_RESULT_MESSAGE]
          final_cols_on_no_groups = sorted(list(set(final_cols_on_no_groups)), key=lambda x: final_cols_on_no_groups.index(x) if x in final_cols_on_no_groups else float('inf'))
+         df_results = df_excel_data.assign(**{'Charge Entry Status': status_arr, COL_RESULT_MESSAGE: reason_arr})
          for col in final_cols_on_no_groups:
             if col not in df_results.columns: df_results[col] = None
          return df_results.reindex(columns=final_cols_on_no_groups).fillna(''), success_groups, fail_groups
 
 
-    pb_proc = st.progress(0)
+    # Only a handful of distinct POS values appear in a sheet, so build each payload once and share it across groups
+    pos_payloads, pos_messages = {}, []
+    for data_dict in valid_groups_to_process.values():
+        pos_val = enc_cols[COL_POS_VALUE][data_dict['row_positions'][0]]
+        if pos_val and pos_val not in pos_payloads: pos_payloads[pos_val] = create_place_of_service_payload(client_obj, pos_val, messages=pos_messages)
+    for msg_type in ("error", "warning"):
+        batch = [m for t, m in pos_messages if t == msg_type]
+        if batch: display_message(msg_type, "Place of Service issues:<br>" + "<br>".join(batch))
+
+    # Same practice for every encounter in the run; built once and shared read-only by all groups
+    prac_pyld = create_practice_identifier_payload(client_obj, current_practice_id)
 
-    for grp_key, data_dict in valid_groups_to_process.items():
-        proc_grp_cnt += 1; pb_proc.progress(proc_grp_cnt / len(valid_groups_to_process))
+    pb_proc = st.progress(0)
+    progress_lock = threading.Lock()
+    progress_step = max(1, len(valid_groups_to_process) // PROGRESS_UPDATES) # Each update is a websocket message
+    acquire_encounter_slot = make_rate_limiter(CREATE_ENCOUNTER_MAX_PER_SEC) # Shared by all workers for this run
+
+    # Log lines and warnings are collected per group and rendered as a few elements once all groups finish;
+    # one Streamlit element per group is a websocket delta each and slows the page on large sheets.
+    group_log, group_messages = {}, []
+    # Encounters already created in this session (e.g. before a re-run after a partial failure), keyed by a fingerprint of
+    # everything the request sends; a matching group reports that EncounterID instead of creating a duplicate
+    created_encounters = st.session_state.setdefault(CREATED_ENCOUNTERS_KEY, {})
+
+    # One CreateEncounter per group; groups are independent, so they run on worker threads like the lookup prefetch.
+    # Returns (status, message) for the group's rows; the shared progress bar is advanced under progress_lock.
+    def process_group(grp_key):
+        nonlocal proc_grp_cnt
+        data_dict = valid_groups_to_process[grp_key]
         pid_for_api, dos_key_str, case_id_for_api = grp_key
 
-        enc_src_dict = data_dict['encounter_details_source_row_dict']
-        sl_to_proc_list = data_dict['service_lines_data_list']
-        orig_indices_list = data_dict['original_df_indices']
+        row_positions_list = data_dict['row_positions']
+        enc_pos = row_positions_list[0] # Encounter-level fields come from the group's first row
         
         grp_api_status, grp_api_message = "Failed", "Group processing did not complete."
-        log_ph = st.empty()
-        
-        first_row_excel_num_for_log = df_results.loc[orig_indices_list[0], 'original_excel_row_num']
-        log_ph.info(f"Processing Group: Pt {pid_for_api}, DOS {dos_key_str}, Case {case_id_for_api} (Excel Rows ~{first_row_excel_num_for_log})")
+        # One log line per group, written when it finishes, instead of a placeholder rewritten at each step
+        grp_log_label = f"Group (Pt {pid_for_api}, DOS {dos_key_str}, Case {case_id_for_api}, Excel Rows ~{enc_cols['original_excel_row_num'][enc_pos]})"
 
         try:
-            rp_name = str(enc_src_dict.get(COL_RENDERING_PROVIDER, "")).strip()
+            rp_name = enc_cols[COL_RENDERING_PROVIDER][enc_pos]
             if not rp_name: raise ValueError(f"'{COL_RENDERING_PROVIDER}' missing.")
-            rp_id = get_provider_id_by_name(client_obj, header_obj, current_practice_id, rp_name)
+            rp_id = lookups["provider"].get(rp_name)
             if not rp_id: raise ValueError(f"Active Provider ID not found for '{rp_name}'.")
 
-            loc_name = str(enc_src_dict.get(COL_LOCATION, "")).strip()
+            loc_name = enc_cols[COL_LOCATION][enc_pos]
             if not loc_name: raise ValueError(f"'{COL_LOCATION}' missing.")
-            loc_id = get_location_id_by_name(client_obj, header_obj, current_practice_id, loc_name)
+            loc_id = lookups["location"].get(loc_name)
             if not loc_id: raise ValueError(f"Location ID not found for '{loc_name}'.")
 
-            sch_p_name = str(enc_src_dict.get(COL_SCHEDULING_PROVIDER, "")).strip()
-            sch_p_pyld = None
+            sch_p_name = enc_cols[COL_SCHEDULING_PROVIDER][enc_pos]
+            sch_p_id, sch_p_pyld = None, None
             if sch_p_name:
-                sch_p_id = get_provider_id_by_name(client_obj, header_obj, current_practice_id, sch_p_name)
-                if not sch_p_id: display_message("warning", f"Group (Pt {pid_for_api}, DOS {dos_key_str}): Active Scheduling Provider ID NOT FOUND for '{sch_p_name}'. Encounter will omit it.")
+                sch_p_id = lookups["provider"].get(sch_p_name)
+                if not sch_p_id: report_message("warning", f"Group (Pt {pid_for_api}, DOS {dos_key_str}): Active Scheduling Provider ID NOT FOUND for '{sch_p_name}'. Encounter will omit it.", group_messages)
                 else: sch_p_pyld = create_provider_identifier_payload(client_obj, sch_p_id)
             
-            batch_num_val = str(enc_src_dict.get(COL_BATCH_NUMBER, "")).strip() if pd.notna(enc_src_dict.get(COL_BATCH_NUMBER)) else None
+            batch_num_val = enc_cols[COL_BATCH_NUMBER][enc_pos]
                 
-            enc_start_dt_api = format_datetime_for_api(enc_src_dict.get(COL_FROM_DATE))
-            enc_end_dt_api = format_datetime_for_api(enc_src_dict.get(COL_THROUGH_DATE))
+            enc_start_dt_api = enc_cols[COL_API_FROM_DATE][enc_pos]
+            enc_end_dt_api = enc_cols[COL_API_THROUGH_DATE][enc_pos]
             if not enc_start_dt_api : raise ValueError(f"Encounter '{COL_FROM_DATE}' invalid for group (key: {dos_key_str}).")
             if not enc_end_dt_api : enc_end_dt_api = enc_start_dt_api
 
@@ -585,59 +984,68 @@ def process_excel_data(client_obj, header_obj, current_practice_id, df_excel_dat
             rp_pyld = create_provider_identifier_payload(client_obj, rp_id)
             sloc_pyld = create_service_location_payload(client_obj, loc_id)
             case_pyld_obj = case_id_type(CaseID=case_id_for_api)
-            prac_pyld = create_practice_identifier_payload(client_obj, current_practice_id)
-
-            pos_excel_val = str(enc_src_dict.get(COL_PLACE_OF_SERVICE_EXCEL, "")).strip()
-            if not pos_excel_val:
-                enc_mode_val = str(enc_src_dict.get(COL_ENCOUNTER_MODE, "")).strip()
-                if enc_mode_val: pos_excel_val = enc_mode_val
-                else: raise ValueError(f"Both '{COL_PLACE_OF_SERVICE_EXCEL}' & '{COL_ENCOUNTER_MODE}' are missing.")
-            pos_pyld = create_place_of_service_payload(client_obj, pos_excel_val)
+
+            pos_excel_val = enc_cols[COL_POS_VALUE][enc_pos]
+            if not pos_excel_val: raise ValueError(f"Both '{COL_PLACE_OF_SERVICE_EXCEL}' & '{COL_ENCOUNTER_MODE}' are missing.")
+            pos_pyld = pos_payloads.get(pos_excel_val)
             if not pos_pyld: raise ValueError(f"POS payload creation failed for '{pos_excel_val}'.")
 
             all_sl_objs = []
             line_errors_grp = []
-            for line_idx, sld_item_dict in enumerate(sl_to_proc_list):
-                if 'original_excel_row_num' not in sld_item_dict:
-                     sld_item_dict['original_excel_row_num'] = df_results.loc[orig_indices_list[line_idx], 'original_excel_row_num']
-
-                sl_obj = create_service_line_payload(client_obj, sld_item_dict, enc_start_dt_api, enc_end_dt_api)
+            # Lines rejected by the up-front validation mask are reported without calling the payload builder
+            sl_errors = sl_cols[COL_LINE_ERROR]
+            for row_pos in row_positions_list:
+                if sl_errors[row_pos]:
+                    line_errors_grp.append(f"SvcLine for Proc '{sl_cols[COL_PROCEDURES][row_pos] or 'N/A'}' (orig Excel row {sl_cols['original_excel_row_num'][row_pos]}): {sl_errors[row_pos]}.")
+                    continue
+                sl_obj = create_service_line_payload(client_obj, sl_cols, row_pos, enc_start_dt_api, enc_end_dt_api, messages=group_messages)
                 if not sl_obj: 
-                    line_errors_grp.append(f"SvcLine for Proc '{sld_item_dict.get(COL_PROCEDURES, 'N/A')}' (orig Excel row {sld_item_dict.get('original_excel_row_num','N/A')}) failed creation.")
+                    line_errors_grp.append(f"SvcLine for Proc '{sl_cols[COL_PROCEDURES][row_pos] or 'N/A'}' (orig Excel row {sl_cols['original_excel_row_num'][row_pos]}) failed creation.")
                     continue
                 all_sl_objs.append(sl_obj)
             
             if line_errors_grp: raise ValueError("Service Line Payload Errors: " + "; ".join(line_errors_grp))
             if not all_sl_objs: raise ValueError("No valid service lines were created for this encounter.")
 
-            sl_arr_pyld = arr_sl_req_type(ServiceLineReq=all_sl_objs)
-            enc_args = {
-                "Patient": pt_pyld, "RenderingProvider": rp_pyld, "ServiceLocation": sloc_pyld,
-                "PlaceOfService": pos_pyld, "ServiceStartDate": enc_start_dt_api, 
-                "ServiceEndDate": enc_end_dt_api, "ServiceLines": sl_arr_pyld, 
-                "Practice": prac_pyld, "EncounterStatus": "Draft", "Case": case_pyld_obj
-            }
-            if sch_p_pyld: enc_args["SchedulingProvider"] = sch_p_pyld
-            if batch_num_val: enc_args["BatchNumber"] = batch_num_val
+            encounter_fingerprint = hashlib.blake2b(repr((current_practice_id, pid_for_api, case_id_for_api, rp_id, loc_id, sch_p_id,
+                                                          pos_excel_val, batch_num_val, enc_start_dt_api, enc_end_dt_api,
+                                                          [tuple(sl_cols[c][p] for c in SERVICE_LINE_COLUMNS) for p in row_positions_list])).encode(), digest_size=16).hexdigest()
+            prior_encounter_id = created_encounters.get(encounter_fingerprint)
+            if prior_encounter_id is not None:
+                grp_api_status, grp_api_message = STATUS_DONE_REUSED, prior_encounter_id
+                report_message("warning", f"{grp_log_label}: identical to EncounterID {prior_encounter_id} already created in this session; not resubmitted.", group_messages)
+            else:
+                sl_arr_pyld = arr_sl_req_type(ServiceLineReq=all_sl_objs)
+                enc_args = {
+                    "Patient": pt_pyld, "RenderingProvider": rp_pyld, "ServiceLocation": sloc_pyld,
+                    "PlaceOfService": pos_pyld, "ServiceStartDate": enc_start_dt_api, 
+                    "ServiceEndDate": enc_end_dt_api, "ServiceLines": sl_arr_pyld, 
+                    "Practice": prac_pyld, "EncounterStatus": "Draft", "Case": case_pyld_obj
+                }
+                if sch_p_pyld: enc_args["SchedulingProvider"] = sch_p_pyld
+                if batch_num_val: enc_args["BatchNumber"] = batch_num_val
             
-            enc_pyld_obj = enc_type(**enc_args) 
-            final_req = create_req_type(RequestHeader=header_obj, Encounter=enc_pyld_obj) 
+                enc_pyld_obj = enc_type(**enc_args) 
+                final_req = create_req_type(RequestHeader=header_obj, Encounter=enc_pyld_obj) 
             
-            log_ph.info(f"Group (Pt {pid_for_api}, DOS {dos_key_str}): Calling CreateEncounter API...")
-            api_resp = client_obj.service.CreateEncounter(request=final_req)
-
-            if hasattr(api_resp, 'ErrorResponse') and api_resp.ErrorResponse and api_resp.ErrorResponse.IsError:
-                grp_api_message = parse_and_simplify_tebra_xml_error(api_resp.ErrorResponse.ErrorMessage, pid_for_api, dos_key_str)
-            elif hasattr(api_resp, 'SecurityResponse') and api_resp.SecurityResponse and not api_resp.SecurityResponse.Authorized:
-                grp_api_message = f"API Auth Error: {api_resp.SecurityResponse.SecurityResult}"
-            elif hasattr(api_resp, 'EncounterID') and api_resp.EncounterID is not None:
-                grp_api_status = "Done" 
-                grp_api_message = f"{api_resp.EncounterID}" 
-                log_ph.success(f"Group (Pt {pid_for_api}, DOS {dos_key_str}): SUCCESS! EncounterID: {api_resp.EncounterID}")
-                success_groups += 1
-            else:
-                raw_resp_str = str(zeep.helpers.serialize_object(api_resp, dict) if api_resp else 'None')
-                grp_api_message = f"Unknown API response: {raw_resp_str[:250]}..."
+                acquire_encounter_slot()
+                api_resp = client_obj.service.CreateEncounter(request=final_req)
+
+                # Each response field is read once; zeep resolves every attribute access through the object's value map
+                err_resp = getattr(api_resp, 'ErrorResponse', None)
+                sec_resp = getattr(api_resp, 'SecurityResponse', None)
+                encounter_id = getattr(api_resp, 'EncounterID', None)
+                if err_resp and err_resp.IsError:
+                    grp_api_message = parse_and_simplify_tebra_xml_error(err_resp.ErrorMessage)
+                elif sec_resp and not sec_resp.Authorized:
+                    grp_api_message = f"API Auth Error: {sec_resp.SecurityResult}"
+                elif encounter_id is not None:
+                    grp_api_status = "Done" 
+                    grp_api_message = f"{encounter_id}" 
+                    created_encounters[encounter_fingerprint] = grp_api_message
+                else:
+                    raw_resp_str = str(zeep.helpers.serialize_object(api_resp, dict) if api_resp else 'None')
+                    grp_api_message = f"Unknown API response: {raw_resp_str[:250]}..."
         
         except ValueError as ve: grp_api_message = str(ve)
         except SoapFault as sf: grp_api_message = f"SOAP FAULT: {sf.message} (Code: {sf.code})"
@@ -645,18 +1053,36 @@ def process_excel_data(client_obj, header_obj, current_practice_id, df_excel_dat
         except Exception as e: 
             grp_api_message = f"UNEXPECTED SCRIPT ERROR: {type(e).__name__} - {str(e)[:150]}"
         
-        if grp_api_status == "Failed":
-             log_ph.error(f"Group (Pt {pid_for_api}, DOS {dos_key_str}): FAILED. {grp_api_message}")
-             fail_groups += 1
-        
-        for orig_df_idx in orig_indices_list:
-            df_results.loc[orig_df_idx, 'Charge Entry Status'] = grp_api_status
-            df_results.loc[orig_df_idx, COL_RESULT_MESSAGE] = grp_api_message
-        
-        time.sleep(0.05)
+        if grp_api_status == "Done": group_log[grp_key] = ("success", f"{grp_log_label}: SUCCESS! EncounterID: {grp_api_message}")
+        elif grp_api_status == STATUS_DONE_REUSED: group_log[grp_key] = ("success", f"{grp_log_label}: ALREADY CREATED this session, EncounterID: {grp_api_message} (not resubmitted)")
+        else: group_log[grp_key] = ("error", f"{grp_log_label}: FAILED. {grp_api_message}")
+
+        with progress_lock:
+            proc_grp_cnt += 1
+            if proc_grp_cnt % progress_step == 0 or proc_grp_cnt == len(valid_groups_to_process): pb_proc.progress(proc_grp_cnt / len(valid_groups_to_process))
+        return grp_api_status, grp_api_message
+
+    group_results = run_bounded_concurrently(process_group, list(valid_groups_to_process))
+    reused_groups = 0
+    for grp_key, (grp_api_status, grp_api_message) in group_results.items():
+        if grp_api_status.startswith("Done"): success_groups += 1 # Includes STATUS_DONE_REUSED
+        else: fail_groups += 1
+        if grp_api_status == STATUS_DONE_REUSED: reused_groups += 1
+        row_positions = valid_groups_to_process[grp_key]['row_positions']
+        status_arr[row_positions] = grp_api_status
+        reason_arr[row_positions] = grp_api_message
+    df_results = df_excel_data.assign(**{'Charge Entry Status': status_arr, COL_RESULT_MESSAGE: reason_arr})
 
     pb_proc.empty()
+    # Sheet order, not completion order; markdown hard line breaks keep one group per line inside each box
+    for msg_type in ("error", "warning"):
+        batch = [m for t, m in group_messages if t == msg_type]
+        if batch: display_message(msg_type, "<br>".join(batch))
+    for log_type, log_fn in (("success", st.success), ("error", st.error)):
+        log_lines = [line for t, line in (group_log[k] for k in valid_groups_to_process if k in group_log) if t == log_type]
+        if log_lines: log_fn("  \n".join(log_lines))
     summary_msg = f"Encounter processing finished. Groups Processed: {proc_grp_cnt}, Successful Groups: {success_groups}, Failed Groups: {fail_groups}."
+    if reused_groups: summary_msg += f" {reused_groups} successful group(s) matched encounters already created this session and were not resubmitted."
     if fail_groups > 0 : display_message("warning", summary_msg + f" Check '{COL_RESULT_MESSAGE}' column in results.")
     else: display_message("success", summary_msg)
     
@@ -664,7 +1090,7 @@ def process_excel_data(client_obj, header_obj, current_practice_id, df_excel_dat
     # Start with the original columns from the input Excel, in their original order
     output_column_order = df_excel_data.columns.tolist()
     # Append the two new status columns at the end
-    if 'Charge Entry Status' not in output_column_order: # Should be added by df_results init
+    if 'Charge Entry Status' not in output_column_order:
         output_column_order.append('Charge Entry Status')
     if COL_RESULT_MESSAGE not in output_column_order: # New result column
         output_column_order.append(COL_RESULT_MESSAGE)
@@ -699,6 +1125,8 @@ def main():
     if 'original_excel_row_num_start' not in st.session_state: 
         st.session_state.original_excel_row_num_start = 2 
 
+    allow_resubmit_val = st.sidebar.checkbox("Resubmit encounters already created this session", value=False, key="sb_allow_resubmit_v5",
+                                             help="Off: groups identical to an encounter created earlier in this session are skipped and reported with its EncounterID.")
     process_button_val = st.sidebar.button("Process Charges", key="sb_process_button_v5")
     results_placeholder = st.container()
 
@@ -710,9 +1138,7 @@ def main():
             
             credentials = {"CustomerKey": customer_key_val, "User": user_email_val, "Password": user_password_val}
             
-            keys_to_clear_main = [k for k in st.session_state if k.startswith("practice_id_") or k.startswith("provider_id_") or k.startswith("location_id_") or k.startswith("patient_case_")]
-            for k_main in keys_to_clear_main: 
-                if k_main in st.session_state: del st.session_state[k_main]
+            refresh_lookup_caches(credentials, allow_resubmit=allow_resubmit_val)
 
             with st.spinner("Connecting to Tebra API and verifying practice..."):
                 client = create_api_client(TEBRA_WSDL_URL)
@@ -724,8 +1150,7 @@ def main():
             display_message("success", f"✅ Connected to Tebra. Practice '{TEBRA_PRACTICE_NAME}' ID: {practice_id_check}.")
             
             try:
-                df_excel_input = pd.read_excel(uploaded_file_val, dtype=str) 
-                df_excel_input.columns = df_excel_input.columns.str.strip()
+                df_excel_input = read_excel_streaming(uploaded_file_val)
                 # Add 'original_excel_row_num' for internal use, will be dropped before final Excel output
                 df_excel_input['original_excel_row_num'] = range(st.session_state.original_excel_row_num_start, st.session_state.original_excel_row_num_start + len(df_excel_input))
 
@@ -752,17 +1177,14 @@ def main():
                     # Display the DataFrame with the new column name and simplified errors
                     st.dataframe(output_df_results) 
                     
-                    # Prepare DataFrame for download (it should already have the correct columns from process_excel_data)
-                    df_for_download = output_df_results.copy()
-                    # Explicitly drop 'original_excel_row_num' if it's still there before download
+                    # process_excel_data already returns the download columns; write_results_excel only reads the frame,
+                    # so it is passed as-is rather than copied. Drop 'original_excel_row_num' if it's still there.
+                    df_for_download = output_df_results
                     if 'original_excel_row_num' in df_for_download.columns:
                         df_for_download = df_for_download.drop(columns=['original_excel_row_num'])
 
 
-                    output_excel_io = io.BytesIO()
-                    with pd.ExcelWriter(output_excel_io, engine='xlsxwriter') as writer:
-                        df_for_download.to_excel(writer, index=False, sheet_name='ChargeEntryResults')
-                    excel_bytes = output_excel_io.getvalue()
+                    excel_bytes = write_results_excel(df_for_download)
                     st.download_button(label="📥 Download Results Excel", data=excel_bytes,
                                        file_name=f"Tebra_Results_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
                                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
@@ -0,0 +1,185 @@
+import datetime, io, os, pickle, sys, logging, threading
+from types import SimpleNamespace as NS
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.WARNING) # Streamlit warns about the missing ScriptRunContext outside `streamlit run`
+import streamlit as st
+import TebraChargeEntry as T
+
+class FakeService:
+    def __init__(self, providers, locations):
+        self.providers, self.locations, self.created = providers, locations, []
+    def GetProviders(self, request):
+        if isinstance(self.providers, Exception): raise self.providers
+        return NS(ErrorResponse=None, SecurityResponse=None, Providers=NS(ProviderData=self.providers))
+    def GetServiceLocations(self, request):
+        if isinstance(self.locations, Exception): raise self.locations
+        return NS(ErrorResponse=None, SecurityResponse=None, ServiceLocations=NS(ServiceLocationData=self.locations))
+
+    def GetPatient(self, request):
+        pid = request.Filter.PatientID
+        return NS(ErrorResponse=None, SecurityResponse=None, Patient=NS(Cases=NS(PatientCaseData=[NS(PatientCaseID=str(pid * 10), IsPrimaryCase='true')])))
+    def CreateEncounter(self, request):
+        self.created.append(request.Encounter)
+        return NS(ErrorResponse=None, SecurityResponse=None, EncounterID=5000 + len(self.created))
+
+class FakeClient:
+    def __init__(self, providers=(), locations=()):
+        self.service = FakeService(list(providers) if not isinstance(providers, Exception) else providers,
+                                   list(locations) if not isinstance(locations, Exception) else locations)
+    def get_type(self, name):
+        return lambda **kw: NS(**kw)
+
+def provider(pid, full_name, active='true'): return NS(ID=str(pid), FullName=full_name, Active=active)
+
+@pytest.fixture(autouse=True)
+def clean_session_state():
+    for k in list(st.session_state): del st.session_state[k]
+    yield
+    for k in list(st.session_state): del st.session_state[k]
+
+# --- Lookup caches ---
+def test_failed_directory_fetch_is_retried_on_next_run():
+    creds = {"CustomerKey": "k", "User": "u", "Password": "p"}
+    T.refresh_lookup_caches(creds)
+    failing = FakeClient(providers=Exception("timeout"), locations=Exception("timeout"))
+    assert T.get_provider_id_by_name(failing, "hdr", 1, "John Smith") is None
+    assert T.get_location_id_by_name(failing, "hdr", 1, "Main Office") is None
+
+    T.refresh_lookup_caches(creds) # Next run, same account, inside the TTL
+    working = FakeClient(providers=[provider(10, "John Smith MD")], locations=[NS(ID='5', Name='Main Office')])
+    assert T.get_provider_id_by_name(working, "hdr", 1, "John Smith") == 10
+    assert T.get_location_id_by_name(working, "hdr", 1, "Main Office") == 5
+
+def test_provider_fetch_does_not_block_location_lookup():
+    release, timed_out = threading.Event(), []
+    class SlowProviders(FakeService):
+        def GetProviders(self, request):
+            if not release.wait(5): timed_out.append(True) # The location lookup waited behind this fetch
+            return super().GetProviders(request)
+    client = FakeClient(providers=[provider(10, "John Smith MD")], locations=[NS(ID='5', Name='Main Office')])
+    client.service = SlowProviders(client.service.providers, client.service.locations)
+    worker = threading.Thread(target=T.get_provider_id_by_name, args=(client, "hdr", 1, "John Smith"), kwargs={"show_spinner": False})
+    worker.start()
+    try: assert T.get_location_id_by_name(client, "hdr", 1, "Main Office", show_spinner=False) == 5
+    finally: release.set(); worker.join()
+    assert not timed_out and st.session_state["provider_id_1_john smith"] == 10
+    pickle.dumps(st.session_state.to_dict()) # runner.enforceSerializableSessionState requires this
+
+# --- Provider matching ---
+@pytest.mark.parametrize("search, expected", [
+    ("John Smith MD", 10), ("john smith", 10), ("Smith John", 10),
+    ("J Smith", 10), ("Smith, J.", 10), ("J. Smith", 10), ("Jo Smith", 10),
+    ("Smit", 10), ("Joh Smith", 10), ("Mary John", 11), ("Johnson", 11),
+    ("Jon Smith", None), ("Old Guy", None),
+])
+def test_get_provider_id_by_name(search, expected):
+    client = FakeClient(providers=[provider(10, "John Smith MD"), provider(11, "Mary Johnson MD"), provider(12, "Old Guy", active='false')])
+    assert T.get_provider_id_by_name(client, "hdr", 1, search) == expected
+
+def test_fragment_match_outside_word_index_wins_tie_by_directory_order():
+    # 'Joh Smith' shares the word 'smith' with both; the earlier entry only matches it through the 'joh' fragment
+    client = FakeClient(providers=[provider(20, "Johanna Smithers"), provider(21, "John Smith")])
+    assert T.get_provider_id_by_name(client, "hdr", 1, "Joh Smith") == 20
+
+# --- Excel input ---
+def workbook_bytes(rows):
+    import openpyxl
+    wb = openpyxl.Workbook(); ws = wb.active
+    for r_i, row in enumerate(rows, 1):
+        for c_i, v in enumerate(row, 1):
+            if v is not None: ws.cell(r_i, c_i, v)
+    buf = io.BytesIO(); wb.save(buf)
+    return buf.getvalue()
+
+def test_read_excel_streaming_names_columns_like_read_excel():
+    data = workbook_bytes([["Diag 1", "Diag 1", "Diag 1.1", 5.0, None, " Units "], ["a", "b", "c", "d", "e", "1"]])
+    df = T.read_excel_streaming(io.BytesIO(data))
+    assert list(df.columns) == ["Diag 1", "Diag 1.2", "Diag 1.1", "5", "Unnamed: 4", "Units"]
+    assert df.iloc[0].tolist() == ["a", "b", "c", "d", "e", "1"]
+
+def test_read_excel_streaming_keeps_cells_right_of_the_header():
+    data = workbook_bytes([["A", "B"], ["1", "2", None, "x"], ["3"], [], []])
+    df = T.read_excel_streaming(io.BytesIO(data))
+    assert list(df.columns) == ["A", "B", "Unnamed: 2", "Unnamed: 3"]
+    assert df.shape == (2, 4) and df.loc[0, "Unnamed: 3"] == "x" and df.loc[1, "B"] != df.loc[1, "B"] # NaN blank
+
+@pytest.mark.parametrize("rows", [
+    [[None, "Patient ID", "Units"], [None, 101, 2.0], [None, None, None], [None, "102", None, "x"]], # Blank column A
+    [[], [None, None, "Patient ID"], [None, None, datetime.datetime(2024, 1, 5)]], # Blank first row and columns A-B
+])
+def test_read_excel_streaming_calamine_matches_openpyxl(rows, monkeypatch):
+    pytest.importorskip("python_calamine")
+    data = workbook_bytes(rows)
+    with_calamine = T.read_excel_streaming(io.BytesIO(data))
+    monkeypatch.setattr(T, "_calamine_workbook_cls", lambda: None)
+    with_openpyxl = T.read_excel_streaming(io.BytesIO(data))
+    pd.testing.assert_frame_equal(with_calamine, with_openpyxl)
+
+# --- Preprocessing ---
+@pytest.mark.filterwarnings("error::FutureWarning")
+def test_to_api_datetime_column_handles_mixed_tz_text():
+    series = pd.Series(["2024-01-05T10:00:00Z", "2024-01-06", "01/07/2024", "not a date", None, "2024-01-06"], dtype=object)
+    assert T._to_api_datetime_column(series).tolist() == ["2024-01-05T10:00:00", "2024-01-06T00:00:00", "2024-01-07T00:00:00", None, None, "2024-01-06T00:00:00"]
+
+def test_preprocess_dataframe_formats_dates_read_from_excel():
+    data = workbook_bytes([[T.COL_FROM_DATE, T.COL_THROUGH_DATE], [datetime.datetime(2024, 1, 5, 13, 30), "01/06/2024"], ["bad date", None]])
+    df = T.read_excel_streaming(io.BytesIO(data))
+    for col in T.EXPECTED_COLUMNS:
+        if col not in df.columns: df[col] = None
+    df_work = T.preprocess_dataframe(df)
+    assert df_work[T.COL_API_FROM_DATE].tolist() == ["2024-01-05T13:30:00", None]
+    assert df_work[T.COL_API_THROUGH_DATE].tolist() == ["2024-01-06T00:00:00", None]
+
+# --- Tebra error parsing ---
+_LINE_ERRORS_XML = ('<Encounter{ns}><ServiceLines><ServiceLine><ProcedureModifier1>59.0<err id="2">Bad modifier, see docs</err></ProcedureModifier1>'
+                    '<ProcedureCode>99213</ProcedureCode><DiagnosisCode2>Q1<err id="3">Invalid code</err></DiagnosisCode2></ServiceLine></ServiceLines></Encounter>')
+_LINE_ERRORS_EXPECTED = ("L1 (Proc 99213): Diag 2 ('Q1') - Invalid code.; "
+                         "L1 (Proc 99213): Mod 1 ('59.0') - Bad modifier. (Note: Modifiers should be 2 chars, e.g., '59' not '59.0').")
+
+@pytest.mark.parametrize("ns", ['', ' xmlns="http://www.kareo.com/api/schemas/"'])
+def test_parse_tebra_error_line_errors(ns):
+    assert T.parse_and_simplify_tebra_xml_error("API Error: " + _LINE_ERRORS_XML.format(ns=ns)) == _LINE_ERRORS_EXPECTED
+
+def test_parse_tebra_error_prefixed_namespace():
+    xml = '<Encounter xmlns:k="urn:k"><k:ServiceLine><k:ProcedureCode>99213</k:ProcedureCode><k:DiagnosisCode1>Z00<k:err id="1">Invalid</k:err></k:DiagnosisCode1></k:ServiceLine></Encounter>'
+    assert T.parse_and_simplify_tebra_xml_error(xml) == "L1 (Proc 99213): Diag 1 ('Z00') - Invalid."
+
+def test_parse_tebra_error_encounter_level_and_malformed():
+    assert T.parse_and_simplify_tebra_xml_error('<Encounter><err id="6100"> Patient case missing </err></Encounter>') == "Encounter Creation Failed: Patient case missing."
+    truncated = '<Encounter><ServiceLine><ProcedureCode>99213</ProcedureCode><DiagnosisCode1>Z00<err id="1">Invalid</err></DiagnosisCode1></ServiceLine>'
+    assert T.parse_and_simplify_tebra_xml_error(truncated) == "L1 (Proc 99213): Diag 1 ('Z00') - Invalid."
+
+# --- Encounter creation ---
+def charge_sheet(n_rows=1):
+    row = dict.fromkeys(T.EXPECTED_COLUMNS, float('nan'))
+    row.update({T.COL_PATIENT_ID: "101", T.COL_FROM_DATE: "2025-01-02", T.COL_RENDERING_PROVIDER: "John Smith", T.COL_LOCATION: "Main Office",
+                T.COL_PLACE_OF_SERVICE_EXCEL: "Office", T.COL_PROCEDURES: "99213", T.COL_UNITS: "1", T.COL_DIAG1: "Z00.00"})
+    df = pd.DataFrame([row] * n_rows, columns=T.EXPECTED_COLUMNS).astype(object)
+    df["original_excel_row_num"] = range(2, 2 + n_rows)
+    return df
+
+def test_identical_encounter_is_not_resubmitted_until_reset():
+    creds = {"CustomerKey": "k", "User": "u", "Password": "p"}
+    client = FakeClient(providers=[provider(10, "John Smith MD")], locations=[NS(ID='5', Name='Main Office')])
+    def run(allow_resubmit=False):
+        T.refresh_lookup_caches(creds, allow_resubmit=allow_resubmit)
+        df_results, success_groups, fail_groups = T.process_excel_data(client, "hdr", 1, charge_sheet())
+        return df_results.loc[0, "Charge Entry Status"], df_results.loc[0, T.COL_RESULT_MESSAGE], success_groups, fail_groups
+
+    assert run() == ("Done", "5001", 1, 0)
+    assert run() == (T.STATUS_DONE_REUSED, "5001", 1, 0) # Reuse path: reported, counted as success, not sent again
+    assert len(client.service.created) == 1
+    assert run(allow_resubmit=True) == ("Done", "5002", 1, 0) # Reset path: the corrected sheet goes to Tebra again
+    assert len(client.service.created) == 2
+    assert run() == (T.STATUS_DONE_REUSED, "5002", 1, 0)
+
+def test_created_encounters_are_forgotten_when_the_account_changes():
+    client = FakeClient(providers=[provider(10, "John Smith MD")], locations=[NS(ID='5', Name='Main Office')])
+    for user in ("a", "b"):
+        T.refresh_lookup_caches({"CustomerKey": "k", "User": user, "Password": "p"})
+        assert T.process_excel_data(client, "hdr", 1, charge_sheet())[0].loc[0, "Charge Entry Status"] == "Done"
+    assert len(client.service.created) == 2